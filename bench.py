@@ -0,0 +1,541 @@
+"""Benchmark latubot functions from the cli"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from itertools import chain
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dateutil.parser
+from dateutil.tz import tzutc
+
+from latubot import notify, records, update
+from latubot.source import kunto
+from latubot.storage import api as storage_api
+
+_FIXTURE = "data/oulu-latu-2020-10-17.txt"
+
+
+def main(parser):
+    args = parser.parse_args()
+    if "func" in args:
+        args.func(args)
+    else:
+        parser.print_help()
+
+
+def measure(func, *args, repeat=5):
+    """Measure best wall time and peak traced memory of func(*args)."""
+    best = min(_timed(func, *args) for _ in range(repeat))
+
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def _timed(func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+
+def report(name, secs, peak=None):
+    """Print one result line."""
+    mem = "" if peak is None else f" {peak / 1024:10.1f} KiB peak"
+    print(f"{name:30} {secs * 1000:10.3f} ms{mem}")
+
+
+def _parse_baseline(txt, sport, earliest):
+    """Parse as before streaming: decode all, filter, parse all dates."""
+    d = json.loads(txt)
+    updates = (f["properties"] for f in d["features"])
+    sport_updates = [v for v in updates if v["type"] == kunto._SPORT_MAP[sport]]
+    for v in sport_updates:
+        v["date"] = _isoparse(v.pop("maintainedAt", None))
+    return [v for v in sport_updates if v["date"] and earliest < v["date"]]
+
+
+def _isoparse(v):
+    try:
+        return dateutil.parser.isoparse(v)
+    except Exception:
+        return None
+
+
+def _parse_streaming(txt, sport, earliest):
+    return kunto._parse_sports(txt, (sport,), earliest)[sport]
+
+
+def _parse(args):
+    txt = open(args.fn).read()
+    earliest = datetime(2020, 10, 17, tzinfo=tzutc()) - timedelta(days=args.days)
+    print(f"parse {args.fn} ({len(txt)} bytes), {args.days} days")
+    for name, func in (("baseline", _parse_baseline), ("streaming", _parse_streaming)):
+        secs, peak = measure(func, txt, args.sport, earliest, repeat=args.repeat)
+        report(name, secs, peak)
+
+
+def _dates(args):
+    txt = open(args.fn).read()
+    values = [f["properties"].get("maintainedAt") for f in kunto._gen_features(txt)]
+    values = [v for v in values if v]
+    print(f"parse {len(values)} maintainedAt values from {args.fn}")
+
+    def parse_dateutil():
+        for v in values:
+            _isoparse(v)
+
+    def parse_cold():
+        kunto._parse_datetime.cache_clear()
+        for v in values:
+            kunto._parse_maintained_at(v)
+
+    def parse_warm():
+        for v in values:
+            kunto._parse_maintained_at(v)
+
+    for name, func in (
+        ("dateutil", parse_dateutil),
+        ("fast path, cold cache", parse_cold),
+        ("fast path, warm cache", parse_warm),
+    ):
+        report(name, measure(func, repeat=args.repeat)[0])
+
+
+def _legacy_update_key(update):
+    """Update key as before: sha256 over all items of the update."""
+    m = hashlib.sha256()
+    for item in chain.from_iterable(sorted(update.to_dict().items())):
+        m.update(str(item).encode())
+        m.update(b"\xc0")
+    return m.digest()[:16]
+
+
+def _legacy_location_doc_name(u):
+    """Location document name as before, not memoized."""
+    m = hashlib.sha256()
+    for item in (u.location.area, u.location.type, u.location.group, u.location.name):
+        m.update(item.encode())
+        m.update(b"\xc0")
+    return m.hexdigest()[:8]
+
+
+def _location_doc_name(u):
+    """Location document name w/o the name saved in the location."""
+    location = u.location
+    return records._location_doc_name(
+        (location.area, location.type, location.group, location.name)
+    )
+
+
+def _hashing(args):
+    txt = open(args.fn).read()
+    updates = kunto._parse_sports(txt, kunto.ALL_SPORTS, None, "OULU")
+    updates = list(chain.from_iterable(updates.values()))
+    print(f"hash {len(updates)} updates from {args.fn}")
+
+    def name_cold():
+        records._location_doc_name.cache_clear()
+        for u in updates:
+            _location_doc_name(u)
+
+    def name_warm():
+        for u in updates:
+            _location_doc_name(u)
+
+    for name, func in (
+        ("update key, legacy", _legacy_update_key),
+        ("update key", update._update_key),
+        ("venue key + fingerprint", _venue_key_and_fingerprint),
+        ("location name, legacy", _legacy_location_doc_name),
+    ):
+        secs = measure(lambda: [func(u) for u in updates], repeat=args.repeat)[0]
+        report(name, secs)
+
+    for name, func in (
+        ("location name, cold cache", name_cold),
+        ("location name, warm cache", name_warm),
+    ):
+        report(name, measure(func, repeat=args.repeat)[0])
+
+
+def _venue_key_and_fingerprint(u):
+    return update._venue_key(u), update._venue_fingerprint(u)
+
+
+def _history_dicts(payloads):
+    """Parse update history as before records: raw property dicts."""
+    history = []
+    for area, txt in payloads:
+        for f in json.loads(txt)["features"]:
+            v = f["properties"]
+            v["date"] = kunto._parse_maintained_at(v.pop("maintainedAt", None))
+            v["area"] = area
+            history.append(v)
+    return history
+
+
+def _history_records(payloads):
+    history = []
+    for area, txt in payloads:
+        updates = kunto._parse_sports(txt, kunto.ALL_SPORTS, None, area)
+        history.extend(chain.from_iterable(updates.values()))
+    return history
+
+
+def _records(args):
+    areas = kunto.ALL_AREAS[: args.areas]
+    synthetic = SyntheticAreas(areas, args.venues, update_ratio=1)
+    now = datetime.now(timezone.utc)
+    payloads = [
+        (area, txt.decode())
+        for i in range(args.steps)
+        for area, txt in synthetic.step(now - timedelta(hours=i)).items()
+    ]
+    n = len(areas) * args.venues * args.steps
+    print(f"history of {n} updates, {len(areas)} areas, {args.steps} steps")
+
+    for name, func in (("dicts", _history_dicts), ("records", _history_records)):
+        kunto._parse_datetime.cache_clear()
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        history = func(payloads)
+        secs = time.perf_counter() - t0
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report(name, secs, peak)
+        print(
+            f"{'':30} {size / 1024:10.1f} KiB kept {size / len(history):10.1f} B/update"
+        )
+        del history
+
+
+class CountingStorage:
+    """Storage proxy counting calls of each storage operation."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if not callable(attr):
+            return attr
+
+        def f(*args, **kwargs):
+            self.calls[name] += 1
+            return attr(*args, **kwargs)
+
+        return f
+
+
+class VenueServer:
+    """Local stand-in for fluentprogress servers.
+
+    Serves payloads by area from /<area>/api/venue/list.
+    """
+
+    def __init__(self):
+        self.payloads = {}
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                body = server.payloads.get(self.path.split("/")[1].upper())
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url_template = f"http://127.0.0.1:{self.httpd.server_port}/{{area}}/"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+class SyntheticAreas:
+    """Generate venue list payloads for areas w/ maintenance history.
+
+    On each step a share of venues in each area is maintained at the
+    step time.
+    """
+
+    _TZ = timezone(timedelta(hours=2))
+
+    def __init__(self, areas, n_venues, update_ratio=0.1, seed=0):
+        self.areas = areas
+        self.n_venues = n_venues
+        self.update_ratio = update_ratio
+        self.rng = random.Random(seed)
+        self.maintained_at = {area: [None] * n_venues for area in areas}
+
+    def step(self, t):
+        """Maintain venues at t, return payloads by area."""
+        payloads = {}
+        for area in self.areas:
+            dates = self.maintained_at[area]
+            for i in range(self.n_venues):
+                if dates[i] is None or self.rng.random() < self.update_ratio:
+                    dates[i] = t.astimezone(self._TZ).isoformat(timespec="milliseconds")
+            payloads[area] = json.dumps(self._collection(area, dates)).encode()
+        return payloads
+
+    def _collection(self, area, dates):
+        features = [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [25.5, 65.0]},
+                "properties": {
+                    "id": i,
+                    "type": "skitrack" if i % 2 else "skatefield",
+                    "group": f"{area.title()} {i % 10}",
+                    "name": f"Venue {i}",
+                    "description": "",
+                    "status": "OPEN",
+                    "images": [],
+                    "maintainedAt": date,
+                },
+            }
+            for i, date in enumerate(dates)
+        ]
+        return {"type": "FeatureCollection", "features": features}
+
+
+def _stage(results, name, storage, func, *args, n_updates=int):
+    """Run one pipeline stage, record wall time, db calls and peak memory.
+
+    n_updates: count processed updates from the stage return value
+    """
+    storage.calls.clear()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    value = func(*args)
+    secs = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = results.setdefault(
+        name, {"secs": 0, "peak": 0, "updates": 0, "db_calls": Counter()}
+    )
+    result["secs"] += secs
+    result["peak"] = max(result["peak"], peak)
+    result["updates"] += n_updates(value)
+    result["db_calls"].update(storage.calls)
+    return value
+
+
+def _pipeline(args):
+    logging.basicConfig(level=logging.WARNING)
+    areas = kunto.ALL_AREAS[: args.areas]
+    for area in areas:
+        os.environ.setdefault(f"LATUBOT_KEYS_SKITRACK_{area}", "a b c d")
+        os.environ.setdefault(f"LATUBOT_KEYS_SKATEFIELD_{area}", "a b c d")
+
+    storage = CountingStorage(storage_api.create_storage(args.storage))
+    storage_api.storage = storage
+    server = VenueServer()
+    kunto._URL_TEMPLATE = server.url_template
+
+    results = {}
+    now = datetime.now(timezone.utc)
+    if args.fixture:
+        fixture = open(args.fixture, "rb").read()
+        steps = [{area: fixture for area in areas}]
+    else:
+        synthetic = SyntheticAreas(areas, args.venues, args.update_ratio)
+        interval = timedelta(days=args.days) / args.steps
+        times = (now - interval * (args.steps - 1 - i) for i in range(args.steps))
+        steps = (synthetic.step(t) for t in times)
+
+    sports = kunto.ALL_SPORTS
+    for payloads in steps:
+        server.payloads = payloads
+        txt = payloads[areas[0]].decode()
+        _stage(
+            results,
+            "parse",
+            storage,
+            kunto._parse_sports,
+            txt,
+            sports,
+            n_updates=lambda d: sum(map(len, d.values())),
+        )
+        _stage(results, "load", storage, update.load_updates, sports, areas, None)
+
+    _stage(results, "notify", storage, notify.notify, f"{args.days + 1}d", False)
+    for name, filter_ in (("get_updates", None), ("get_updates filtered", "Venue 1")):
+        _stage(results, name, storage, notify.get_updates, filter_, 10, n_updates=len)
+
+    params = {k: v for k, v in vars(args).items() if k != "func"}
+    stages = {}
+    for name, result in results.items():
+        db_calls = sum(result["db_calls"].values())
+        stages[name] = {
+            "secs": result["secs"],
+            "peak_kib": result["peak"] / 1024,
+            "updates": result["updates"],
+            "db_calls": dict(result["db_calls"]),
+            "db_calls_per_update": db_calls / max(1, result["updates"]),
+        }
+        report(name, result["secs"], result["peak"])
+        print(f"{'':30} {result['updates']:10} updates {db_calls:10} db calls")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            report_ = {"time": now.isoformat(), "params": params, "stages": stages}
+            json.dump(report_, f, indent=2)
+
+
+# Entry points w/ request args, and setup to skip fetching from servers
+_ENTRY_POINTS = {
+    "load_updates_http": ({"area": "OULU"}, True),
+    "notify_http": ({"since": "1h"}, False),
+    "drain_http": ({}, False),
+    "load_and_notify_http": ({"area": "OULU", "since": "1h"}, True),
+    "get_updates_http": ({"n": "1"}, False),
+}
+
+_IMPORT_SCRIPT = """
+import sys
+import main
+if {skip_fetch}:
+    from latubot.source import kunto
+    kunto._load_raw_data = lambda area, cache_key=None: (None, None)
+
+class Request:
+    args = {args!r}
+    headers = {{}}
+
+try:
+    main.{entry_point}(Request())
+except Exception as e:
+    print(f"error {{e!r}}", file=sys.stderr)
+"""
+
+_HEAVY_MODULES = ("tweepy", "requests", "google.cloud.firestore", "dateutil.parser")
+
+
+def _import_time(script, env):
+    """Run script in a new interpreter, return (import secs, imported modules)."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    secs = 0
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us, _, name = line[len("import time:") :].split("|")
+            if self_us.strip().isdigit():
+                secs += int(self_us) / 1e6
+                modules.add(name.strip())
+        elif line.startswith("error"):
+            logging.warning(line)
+    return secs, modules
+
+
+def _imports(args):
+    env = {**os.environ, "LATUBOT_STORAGE": args.storage}
+    base_secs, base_modules = min(_import_time("pass", env) for _ in range(args.repeat))
+    print(f"import time of entry points w/ {args.storage} storage, first call")
+
+    slow = []
+    for entry_point, (request_args, skip_fetch) in _ENTRY_POINTS.items():
+        script = _IMPORT_SCRIPT.format(
+            entry_point=entry_point, args=request_args, skip_fetch=skip_fetch
+        )
+        secs, modules = min(
+            (_import_time(script, env) for _ in range(args.repeat)),
+            key=lambda x: x[0],
+        )
+        secs -= base_secs
+        heavy = [m for m in _HEAVY_MODULES if m in modules]
+        report(entry_point, secs)
+        print(f"{'':30} {len(modules - base_modules):10} modules, heavy: {heavy}")
+        if args.max_ms is not None and secs * 1000 > args.max_ms:
+            slow.append(entry_point)
+
+    if slow:
+        sys.exit(f"import time over {args.max_ms} ms: {', '.join(slow)}")
+
+
+def arg_parser():
+    """Create argument parser."""
+    parser = argparse.ArgumentParser("latubot benchmarks")
+    parser.add_argument("--repeat", "-r", type=int, default=5)
+
+    subparsers = parser.add_subparsers()
+
+    # parse
+    parse_parser = subparsers.add_parser("parse")
+    parse_parser.set_defaults(func=_parse)
+    parse_parser.add_argument("--fn", default=_FIXTURE)
+    parse_parser.add_argument("--sport", "-s", default="latu")
+    parse_parser.add_argument("--days", type=int, default=365)
+
+    # dates
+    dates_parser = subparsers.add_parser("dates")
+    dates_parser.set_defaults(func=_dates)
+    dates_parser.add_argument("--fn", default=_FIXTURE)
+
+    # hashing
+    hashing_parser = subparsers.add_parser("hashing")
+    hashing_parser.set_defaults(func=_hashing)
+    hashing_parser.add_argument("--fn", default=_FIXTURE)
+
+    # records
+    records_parser = subparsers.add_parser("records")
+    records_parser.set_defaults(func=_records)
+    records_parser.add_argument("--areas", type=int, default=5)
+    records_parser.add_argument("--venues", type=int, default=1000)
+    records_parser.add_argument("--steps", type=int, default=20)
+
+    # imports
+    imports_parser = subparsers.add_parser("imports")
+    imports_parser.set_defaults(func=_imports)
+    imports_parser.add_argument("--storage", default="memory")
+    imports_parser.add_argument(
+        "--max-ms", type=float, help="fail if an entry point imports longer"
+    )
+
+    # pipeline
+    pipeline_parser = subparsers.add_parser("pipeline")
+    pipeline_parser.set_defaults(func=_pipeline)
+    pipeline_parser.add_argument(
+        "--fixture", help="serve fixture file for all areas instead of synthetic data"
+    )
+    pipeline_parser.add_argument("--areas", type=int, default=len(kunto.ALL_AREAS))
+    pipeline_parser.add_argument("--venues", type=int, default=200)
+    pipeline_parser.add_argument("--days", type=int, default=90)
+    pipeline_parser.add_argument("--steps", type=int, default=30)
+    pipeline_parser.add_argument("--update-ratio", type=float, default=0.1)
+    pipeline_parser.add_argument("--storage", default="memory")
+    pipeline_parser.add_argument("--output", "-o", help="save results in json file")
+
+    return parser
+
+
+if __name__ == "__main__":
+    main(arg_parser())
@@ -0,0 +1,88 @@
+"""In-process caches."""
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache w/ optional time to live for entries.
+
+    Cache is shared between threads, e.g. concurrent area fetches.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        """Get a value, default if missing or expired."""
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        """Put a value, evict least recently used values if full.
+
+        ttl: time to live of this value if not the cache's ttl
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def keys(self):
+        """Unexpired keys from least to most recently used."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                k
+                for k, (_, expires) in self._data.items()
+                if expires is None or now <= expires
+            ]
+
+    def items(self):
+        """Unexpired (key, value) items from least to most recently used."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (k, value)
+                for k, (value, expires) in self._data.items()
+                if expires is None or now <= expires
+            ]
+
+    def clear(self):
+        """Remove all values."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Cache statistics."""
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
@@ -14,8 +14,73 @@ MIN_MINS_BETWEEN_UPDATES = 120
 # Max update age in minutes for an update to be notified
 MAX_UPDATE_AGE_TO_NOTIFY = 0
 
-# Sleep a while after each sent tweet to avoid spamming
+# Storage backend: "firestore", "sqlite:<path>" or "memory"
+STORAGE = os.environ.get("LATUBOT_STORAGE", "firestore")
+
+# Max number of areas fetched concurrently from fluentprogress servers
+MAX_CONCURRENT_FETCHES = 8
+
+# Timeout in seconds to connect to and read from fluentprogress servers
+FETCH_TIMEOUT = 30
+
+# Optional file to persist fluentprogress http cache validators between runs,
+# cache is kept only in process memory if not set
+HTTP_CACHE_FN = os.environ.get("LATUBOT_HTTP_CACHE_FN")
+
+# Optional directory to archive every fetched venue list response in,
+# compressed and deduplicated, see latubot/source/archive.py
+RAW_ARCHIVE = os.environ.get("LATUBOT_RAW_ARCHIVE")
+
+# Max number of locations cached in memory and time in seconds to keep them
+LOCATION_CACHE_SIZE = 10000
+LOCATION_CACHE_TTL = 6 * 3600
+
+# Max number of loaded updates remembered to skip already seen updates, and
+# time in seconds to remember them
+SEEN_UPDATES_SIZE = 20000
+SEEN_UPDATES_TTL = 7 * 24 * 3600
+
+# Optional snapshot of seen updates loaded at startup and saved after each
+# load: a file path, or "db" to save in storage (e.g. a firestore document)
+SEEN_UPDATES_SNAPSHOT = os.environ.get("LATUBOT_SEEN_UPDATES_SNAPSHOT")
+
+# Optional per-area snapshots of venue fingerprints loaded on first load of
+# an area and saved after changes: a directory, or "db" to save in storage
+AREA_SNAPSHOTS = os.environ.get("LATUBOT_AREA_SNAPSHOTS")
+
+# Max number of get_updates_http responses cached in an instance and time in
+# seconds to cache them, also sent as max-age to clients
+GET_UPDATES_CACHE_SIZE = 256
+GET_UPDATES_CACHE_TTL = 60
+
+# Allow profiling cloud functions w/ "profile" param, response is replaced
+# by the profile report
+PROFILING = os.environ.get("LATUBOT_PROFILING") == "1"
+
+# Daemon polling interval of an area in seconds, adapted between min and max
+# from the update history of the area by hour of day, and the decay of the
+# history per day
+DAEMON_MIN_INTERVAL = 5 * 60
+DAEMON_MAX_INTERVAL = 60 * 60
+DAEMON_HISTORY_DECAY = 0.9
+
+# Space tweets to one twitter account to avoid spamming: on average one tweet
+# per SECS_TO_SLEEP_AFTER_TWEET, at most TWEET_BURST tweets in a row
 SECS_TO_SLEEP_AFTER_TWEET = 10
+TWEET_BURST = 1
+
+# Notification outbox: max number of send attempts before giving up on a
+# message, delay in seconds before the first retry (doubled on each retry),
+# max number of messages sent per drain and number of sent messages per
+# acknowledgement write
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_SECS = 60
+OUTBOX_DRAIN_SIZE = 100
+OUTBOX_ACK_BATCH = 10
+
+# Time in seconds a drain holds messages it's sending, longer than a drain
+# takes w/ tweets spaced per account
+OUTBOX_LEASE_SECS = 3600
 
 # Tweet format
 # For now cannot separate city and place from tweeted msg, change
@@ -0,0 +1,112 @@
+"""Long-running daemon to load and notify in-process.
+
+- poll each area on its own schedule
+- adapt polling interval of an area from its update history by hour of day,
+  e.g. poll often during morning grooming hours and seldom in summer
+- load all due areas at once, at most `concurrency` fetches at a time
+- notify new updates as they are saved, w/o reading them back from db
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+from latubot import cfg
+from latubot.notify import load_and_notify
+from latubot.source import api
+from latubot.time_utils import fin_tz
+
+logger = logging.getLogger(__name__)
+
+
+class AreaSchedule:
+    """Polling schedule of an area adapted from its update history.
+
+    History is the number of changed venues seen by local hour of day,
+    decayed by cfg.DAEMON_HISTORY_DECAY per day. In steady state
+    history[hour] * (1 - decay) is the expected number of updates per day
+    in that hour, and the area is polled about once per expected update.
+    The first poll is left out of history, as all venues are changed
+    without a previous snapshot.
+    """
+
+    def __init__(self, area, now):
+        self.area = area
+        self.next_poll = now
+        self.history = [0.0] * 24
+        self._decayed_at = now
+        self._polled = False
+
+    def observe(self, now, n):
+        """Record n changed venues seen at now, schedule next poll."""
+        decay = cfg.DAEMON_HISTORY_DECAY ** ((now - self._decayed_at) / 86400)
+        self.history = [v * decay for v in self.history]
+        self._decayed_at = now
+        if self._polled:
+            self.history[_local_hour(now)] += n
+        self._polled = True
+
+        interval = self.interval(now)
+        self.next_poll = now + interval
+        logger.debug(f"Next poll of {self.area} in {interval:.0f}s")
+
+    def interval(self, now):
+        """Polling interval in seconds at now."""
+        per_hour = self.history[_local_hour(now)] * (1 - cfg.DAEMON_HISTORY_DECAY)
+        secs = 3600 / per_hour if per_hour > 0 else cfg.DAEMON_MAX_INTERVAL
+        return min(cfg.DAEMON_MAX_INTERVAL, max(cfg.DAEMON_MIN_INTERVAL, secs))
+
+
+def run(
+    sports=None,
+    areas=None,
+    since="1d",
+    notify_since="2h",
+    tweet=False,
+    concurrency=None,
+    stop=None,
+):
+    """Load and notify until stop (a threading.Event) is set."""
+    sports = sports or api.sport_names()
+    areas = areas or api.area_names()
+    stop = stop or threading.Event()
+    logger.info(f"Start daemon for {sports} in {areas}")
+
+    now = time.time()
+    schedules = [AreaSchedule(area, now) for area in areas]
+    while not stop.is_set():
+        due = [s for s in schedules if s.next_poll <= time.time()]
+        if due:
+            _poll(due, sports, since, notify_since, tweet, concurrency)
+
+        next_poll = min(s.next_poll for s in schedules)
+        stop.wait(max(0, next_poll - time.time()))
+
+    logger.info("Stop daemon")
+
+
+def _poll(schedules, sports, since, notify_since, tweet, concurrency):
+    """Load due areas and notify, reschedule areas."""
+    changes = {}
+    try:
+        areas = [s.area for s in schedules]
+        load_and_notify(
+            sports,
+            areas,
+            since,
+            notify_since,
+            tweet,
+            concurrency=concurrency,
+            changes=changes,
+        )
+    except Exception:
+        logger.exception("Poll failed")
+
+    now = time.time()
+    for s in schedules:
+        s.observe(now, changes.get(s.area, 0))
+
+
+def _local_hour(timestamp):
+    return datetime.fromtimestamp(timestamp, fin_tz).hour
@@ -1,12 +1,18 @@
 """Google cloud related functionality."""
 
 import logging
+from itertools import islice
 
 from google.cloud import firestore
 
+from latubot import metrics
+
 db = None
 logger = logging.getLogger(__name__)
 
+# Max number of documents in one batched read or write in firestore
+MAX_BATCH_SIZE = 500
+
 
 def get_db():
     """Lazy init db"""
@@ -15,3 +21,36 @@ def get_db():
         logger.info("Initialize firestone client")
         db = firestore.Client()
     return db
+
+
+def get_all(refs):
+    """Generate document snapshots for references w/ batched reads."""
+    for chunk in chunks(refs, MAX_BATCH_SIZE):
+        metrics.inc("firestore_documents_total", len(chunk), op="read")
+        yield from get_db().get_all(chunk)
+
+
+def write(items, merge=False):
+    """Write (document reference, data) items in db in batches.
+
+    Returns the number of written documents.
+    """
+    n = 0
+    for chunk in chunks(items, MAX_BATCH_SIZE):
+        batch = get_db().batch()
+        for ref, data in chunk:
+            batch.set(ref, data, merge=merge)
+        batch.commit()
+        metrics.inc("firestore_documents_total", len(chunk), op="write")
+        n += len(chunk)
+    return n
+
+
+def chunks(items, size):
+    """Split items into lists of at most size items."""
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
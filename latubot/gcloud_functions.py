@@ -1,48 +1,244 @@
-"""Google cloud function entry points"""
+"""Google cloud function entry points
+
+Each entry point imports what it uses on first call, to keep cold starts of
+the other entry points fast, see `python bench.py imports`.
+"""
 
 import logging
+import functools
+import gzip
+import hashlib
 import json
+import os
+import tempfile
 
-from latubot.notify import notify, get_updates
-from latubot.update import load_updates
+from latubot import cfg
+from latubot.cache import TTLCache
 from latubot.time_utils import DateTimeEncoder
 
 
+def _profiled(func):
+    """Decorator to profile a function if cfg.PROFILING and "profile" is given.
+
+    Response is replaced by the profile report, raw profile is saved in a
+    temp dir of the instance.
+    """
+
+    @functools.wraps(func)
+    def wrapper(request):
+        if not (cfg.PROFILING and "profile" in request.args):
+            return func(request)
+
+        from latubot.profiling import Profile
+
+        with Profile() as p:
+            func(request)
+        p.save(os.path.join(tempfile.gettempdir(), func.__name__))
+        return p.report, 200, {"Content-Type": "text/plain"}
+
+    return wrapper
+
+
+@_profiled
 def load_updates_http(request):
     """Gcloud function, triggered by http request."""
+    from latubot.update import load_updates
+
     sport = tuple(filter(None, request.args.get("sport", "latu").split(",")))
     area = tuple(filter(None, request.args.get("area", "OULU,SYOTE").split(",")))
     since = request.args.get("since", None)
+    concurrency = int(request.args.get("concurrency", 0)) or None
     log_level = request.args.get("log_level")
 
     _init_logging(log_level)
 
-    n = load_updates(sport, area, since)
-    return f"Loaded {n} new updates"
+    summary = {}
+    n = load_updates(sport, area, since, concurrency, summary=summary)
+    return _response(request, f"Loaded {n} new updates", summary)
 
 
+@_profiled
 def notify_http(request):
     """Gcloud function, triggered by http request."""
+    from latubot.notify import notify
+
     since = request.args.get("since", None)
     tweet = "tweet" in request.args
+    drain_ = request.args.get("drain", "1") != "0"
     log_level = request.args.get("log_level")
 
     _init_logging(log_level)
 
-    n = notify(since, tweet)
-    return f"Sent {n} notifications from updates since {since}"
+    summary = {}
+    n = notify(since, tweet, drain_, summary=summary)
+    return _response(
+        request, f"Queued {n} notifications from updates since {since}", summary
+    )
 
 
-def get_updates_http(request):
+@_profiled
+def drain_http(request):
+    """Gcloud function, triggered by http request."""
+    from latubot.outbox import drain
+
+    tweet = "tweet" in request.args
+    n = int(request.args.get("n", 0)) or None
+    log_level = request.args.get("log_level")
+
+    _init_logging(log_level)
+
+    summary = {}
+    n = drain(tweet, n, summary=summary)
+    return _response(request, f"Sent {n} notifications", summary)
+
+
+@_profiled
+def load_and_notify_http(request):
     """Gcloud function, triggered by http request."""
+    from latubot.notify import load_and_notify
+
+    sport = tuple(filter(None, request.args.get("sport", "latu").split(",")))
+    area = tuple(filter(None, request.args.get("area", "OULU,SYOTE").split(",")))
+    since = request.args.get("since", None)
+    notify_since = request.args.get("notify_since", None)
+    tweet = "tweet" in request.args
+    drain_ = request.args.get("drain", "1") != "0"
+    concurrency = int(request.args.get("concurrency", 0)) or None
+    log_level = request.args.get("log_level")
+
+    _init_logging(log_level)
+
+    summary = {}
+    n = load_and_notify(
+        sport, area, since, notify_since, tweet, drain_, concurrency, summary=summary
+    )
+    return _response(request, f"Queued {n} notifications from new updates", summary)
+
+
+# get_updates_http responses by request params, see _get_updates_response
+_updates_cache = TTLCache(cfg.GET_UPDATES_CACHE_SIZE, cfg.GET_UPDATES_CACHE_TTL)
+_updates_cache_generation = None
+
+
+@_profiled
+def get_updates_http(request):
+    """Gcloud function, triggered by http request.
+
+    Responses are cached in the instance, and can be revalidated w/ ETag.
+    JSON is compact unless "pretty" is given, and gzipped if accepted.
+    Invalid n or cursor is a 400 response.
+    """
+    from latubot.storage.base import InvalidCursor
+
     filter_ = request.args.get("filter")
-    n = int(request.args.get("n", 10))
+    n = request.args.get("n", "10")
+    cursor = request.args.get("cursor")
+    latest = "latest" in request.args
+    pretty = "pretty" in request.args
     log_level = request.args.get("log_level")
 
     _init_logging(log_level)
 
-    updates = get_updates(filter_, n)
-    return json.dumps(updates, indent=2, cls=DateTimeEncoder, sort_keys=True)
+    if not n.isdigit() or int(n) < 1:
+        return f"Invalid n {n!r}", 400
+    try:
+        body, etag, next_cursor = _get_updates_response(
+            filter_, int(n), cursor, latest, pretty
+        )
+    except InvalidCursor as e:
+        return str(e), 400
+    # gzipped and identity responses are different representations
+    gzipped = _accepts_gzip(request.headers.get("Accept-Encoding"))
+    if gzipped:
+        etag = f'{etag[:-1]}-gz"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={cfg.GET_UPDATES_CACHE_TTL}",
+        "Vary": "Accept-Encoding",
+    }
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if _etag_matches(request.headers.get("If-None-Match"), etag):
+        return "", 304, headers
+
+    headers["Content-Type"] = "application/json"
+    if gzipped:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    return body, 200, headers
+
+
+def _get_updates_response(filter_, n, cursor, latest, pretty):
+    """Get (json body, etag, next cursor), cached until updates are saved."""
+    from latubot.notify import get_latest_updates, get_updates_page
+    from latubot.update import save_generation
+
+    global _updates_cache_generation
+    if _updates_cache_generation != save_generation():
+        _updates_cache.clear()
+        _updates_cache_generation = save_generation()
+
+    key = (filter_, n, cursor, latest, pretty)
+    response = _updates_cache.get(key)
+    if response is not None:
+        return response
+
+    if latest:
+        updates, next_cursor = get_latest_updates(filter_, n), None
+    else:
+        updates, next_cursor = get_updates_page(filter_, n, cursor)
+    if pretty:
+        body = json.dumps(updates, indent=2, cls=DateTimeEncoder, sort_keys=True)
+    else:
+        body = json.dumps(
+            updates, separators=(",", ":"), cls=DateTimeEncoder, sort_keys=True
+        )
+    body = body.encode()
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+    response = (body, etag, next_cursor)
+    _updates_cache.put(key, response)
+    return response
+
+
+def _etag_matches(if_none_match, etag):
+    """Check if an If-None-Match header value matches etag."""
+    if not if_none_match:
+        return False
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return any(tag in ("*", etag, f"W/{etag}") for tag in tags)
+
+
+def _accepts_gzip(accept_encoding):
+    """Check if an Accept-Encoding header value accepts gzip.
+
+    gzip is accepted if listed, or covered by "*", w/ a non-zero q-value.
+    """
+    qvalues = {}
+    for item in (accept_encoding or "").split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.lower()] = q
+
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qvalues:
+            return qvalues[coding] > 0
+    return False
+
+
+def _response(request, msg, summary):
+    """Response message, as json w/ metrics summary if "summary" is given."""
+    if "summary" not in request.args:
+        return msg
+    body = json.dumps({"message": msg, "summary": summary}, sort_keys=True)
+    return body, 200, {"Content-Type": "application/json"}
 
 
 def _init_logging(level=None):
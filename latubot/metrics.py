@@ -0,0 +1,114 @@
+"""Lightweight in-process metrics.
+
+- counters and timers w/ labels, cumulative per process
+- structured summary of a call, see summarized
+- prometheus text format, see prometheus_text
+"""
+
+import functools
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+_PREFIX = "latubot_"
+
+# Metric values by (name, labels)
+_values = Counter()
+_lock = threading.Lock()
+
+
+def inc(name, value=1, **labels):
+    """Increment a counter."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _values[key] += value
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time a block, record sum of seconds and count as name_seconds."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        inc(f"{name}_seconds_sum", time.perf_counter() - t0, **labels)
+        inc(f"{name}_seconds_count", **labels)
+
+
+def snapshot():
+    """Copy of current metric values."""
+    with _lock:
+        return Counter(_values)
+
+
+def since(before):
+    """Metric values changed since a snapshot."""
+    values = snapshot()
+    values.subtract(before)
+    return Counter({k: v for k, v in values.items() if v})
+
+
+def summarize(values):
+    """Structured summary of metric values.
+
+    Returns {name: value} for metrics w/o labels, and
+    {name: {"label=value,...": value}} for metrics w/ labels.
+    """
+    summary = defaultdict(dict)
+    for (name, labels), value in sorted(values.items()):
+        if labels:
+            summary[name][",".join(f"{k}={v}" for k, v in labels)] = value
+        else:
+            summary[name] = value
+    return dict(summary)
+
+
+def summarized(func):
+    """Decorator to time func as a stage and summarize its metrics.
+
+    Summary of metrics recorded during the call is saved in the optional
+    summary (a dict) keyword argument.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, summary=None, **kwargs):
+        before = snapshot()
+        try:
+            with timer("stage", stage=func.__name__):
+                return func(*args, **kwargs)
+        finally:
+            if summary is not None:
+                summary.update(summarize(since(before)))
+
+    return wrapper
+
+
+def prometheus_text(values=None):
+    """Metric values in prometheus text format, all metrics by default."""
+    values = snapshot() if values is None else values
+    families = defaultdict(list)
+    for (name, labels), value in sorted(values.items()):
+        family = name
+        for suffix in ("_sum", "_count"):
+            if name.endswith(f"_seconds{suffix}"):
+                family = name[: -len(suffix)]
+        families[family].append((name, labels, value))
+
+    lines = []
+    for family, samples in families.items():
+        kind = "summary" if family.endswith("_seconds") else "counter"
+        lines.append(f"# TYPE {_PREFIX}{family} {kind}")
+        for name, labels, value in samples:
+            lines.append(f"{_PREFIX}{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
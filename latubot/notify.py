@@ -1,148 +1,218 @@
 """Notification functions.
 
 - find updates to notify
-  - find all update docs from db since
+  - find latest status of each location updated since, or take updates
+    just saved by load_new_updates
   - skip if notified too recently
   - skip if update already too old
+- updates are records.Update, status dicts from storage are converted
+  w/ cached locations
 - notify
+  - queue notification into the outbox
   - save notification time
-  - send notification
+  - drain the outbox, i.e. send notifications, unless done separately
 """
 
 import logging
 from datetime import datetime, timezone, timedelta
 from collections import defaultdict
-from itertools import islice
 from typing import Iterable
 
-from google.cloud import firestore
-
 from latubot.time_utils import since_to_delta
-from latubot.gcloud import get_db
-from latubot import cfg
-from latubot.tweet import tweet_update
-from latubot.update import load_location
+from latubot.storage.api import get_storage
+from latubot import cfg, metrics
+from latubot.update import (
+    load_all_locations,
+    load_locations,
+    load_new_updates,
+    location_cache_stats,
+    updates_from_statuses,
+)
 
 logger = logging.getLogger(__name__)
 
 
-def get_updates(filter_=None, n=10):
-    """Get latest updates."""
-    filter_keys = ("name", "group", "area")
+def get_updates(filter_=None, n=10, cursor=None):
+    """Get latest updates.
+
+    filter_: substring of location name, group or area
+    cursor: cursor of the previous page from get_updates_page
+    """
+    updates, _ = get_updates_page(filter_, n, cursor)
+    return updates
+
 
-    def f(update):
-        return filter_ is None or any(filter_ in update[k] for k in filter_keys)
+def get_updates_page(filter_=None, n=10, cursor=None):
+    """Get a page of latest updates, return (updates, cursor of next page)."""
+    locations = None
+    if filter_ is not None:
+        locations = _find_locations(filter_)
+        if not locations:
+            return (), None
 
-    filtered_updates = filter(f, _find_latest_updates())
-    return tuple(islice(filtered_updates, n))
+    docs, next_cursor = get_storage().find_latest_updates(locations, n, cursor)
+    return _to_dicts(docs), next_cursor
 
 
-def _find_latest_updates():
-    """Generate update documents from firestore in reverse order."""
-    query = (
-        get_db()
-        .collection_group("updates")
-        .order_by("date", direction=firestore.Query.DESCENDING)
-    )
-    for doc_ref in query.stream():
-        doc = doc_ref.to_dict()
-        location = load_location(doc["location"])
-        yield {**location, **doc}
+def get_latest_updates(filter_=None, n=10):
+    """Get latest update of each location, newest first.
+
+    Reads one latest status per location instead of the update history.
+    """
+    locations = None
+    if filter_ is not None:
+        locations = _find_locations(filter_)
+        if not locations:
+            return ()
+
+    docs = get_storage().find_latest()
+    if locations is not None:
+        docs = [doc for doc in docs if doc["location"] in locations]
+    docs = sorted(docs, key=lambda doc: doc["date"], reverse=True)[:n]
+    return _to_dicts(docs)
 
 
-def notify(since="15m", tweet=False):
-    """Send notifications for updates."""
+def _to_dicts(docs):
+    """Status update dicts from storage w/ location fields."""
+    locations = load_locations(doc["location"] for doc in docs)
+    return tuple({**locations[doc["location"]].to_dict(), **doc} for doc in docs)
+
+
+def _find_locations(filter_):
+    """Find names of locations w/ filter_ in name, group or area."""
+    return {
+        doc_name
+        for doc_name, location in load_all_locations().items()
+        if any(
+            filter_ in (v or "") for v in (location.name, location.group, location.area)
+        )
+    }
+
+
+@metrics.summarized
+def notify(since="15m", tweet=False, drain=True):
+    """Queue notifications for updates, and send them if drain.
+
+    Returns the number of queued notifications.
+    """
     since = since or "15m"
+    return notify_updates(_find_latest_since(since), tweet, drain)
+
+
+@metrics.summarized
+def load_and_notify(
+    sports=None,
+    areas=None,
+    since=None,
+    notify_since="15m",
+    tweet=False,
+    drain=True,
+    concurrency=None,
+    changes=None,
+):
+    """Load updates, and notify new ones w/o reading them back from db.
+
+    Only updates since notify_since are notified, like in notify. Returns
+    the number of queued notifications.
+    """
+    earliest = _earliest(notify_since or "15m")
+    updates = load_new_updates(sports, areas, since, concurrency, changes)
+    return notify_updates((u for u in updates if u.date > earliest), tweet, drain)
+
 
-    i = 0
-    for i, update in enumerate(_find_updates(since)):
-        _notify_one_update(update, tweet)
+def notify_updates(updates, tweet=False, drain=True):
+    """Queue notifications for status updates, and send them if drain.
+
+    Returns the number of queued notifications.
+    """
+    from latubot import outbox
 
-    return i
+    with metrics.timer("stage", stage="find"):
+        updates = list(_find_updates(updates))
+    queued = outbox.enqueue(updates)
+    _save_notification_times(queued)
+    if drain:
+        # pretend to send only the queued messages, pending messages of
+        # other runs are left for a real drain
+        ids = None if tweet else [outbox.message_id(u) for u in queued]
+        outbox.drain(tweet, ids=ids)
 
+    logger.info(f"Location cache {location_cache_stats()}")
+    return len(queued)
 
-def _find_updates(since: str):
-    """Find updates from firestore db since."""
-    updates = _find_update_docs_since(since)
+
+def _find_updates(updates):
+    """Find updates to notify from status updates."""
     newest_update_per_location = _find_newest_update_by_location(updates)
-    logger.info(f"Found {len(newest_update_per_location)} updates since {since}")
+    logger.info(f"Found {len(newest_update_per_location)} updated locations")
     yield from _gen_updates_to_notify(newest_update_per_location)
 
 
-def _find_update_docs_since(since: str):
-    """Find all update documents from firestore since."""
-    delta = since_to_delta(since)
-    earliest_dt = datetime.now(timezone.utc) - delta
-    query = get_db().collection_group("updates").where("date", ">", earliest_dt)
-    return (doc.to_dict() for doc in query.stream())
+def _find_latest_since(since: str):
+    """Find latest status of locations updated since from db."""
+    return updates_from_statuses(get_storage().find_latest(_earliest(since)))
+
+
+def _earliest(since: str):
+    return datetime.now(timezone.utc) - since_to_delta(since)
 
 
 def _find_newest_update_by_location(updates: Iterable) -> Iterable:
     """Limit to newest update for each location."""
     d = defaultdict(list)
     for update in updates:
-        d[update["location"]].append(update)
+        d[update.location.doc_name].append(update)
 
     for k, v in d.items():
-        d[k] = max(v, key=lambda x: x["date"])
+        d[k] = max(v, key=lambda x: x.date)
 
     return d.values()
 
 
 def _gen_updates_to_notify(updates):
     """Generate updates that should be notified."""
+    fresh_updates = []
     for update in updates:
-        update_age = datetime.now(timezone.utc) - update["date"]
+        update_age = datetime.now(timezone.utc) - update.date
         if update_age > timedelta(minutes=cfg.MAX_UPDATE_AGE_TO_NOTIFY) > timedelta(0):
-            logger.debug(f"Skip {update['location']} update too old {update_age}")
-            continue
+            logger.debug(f"Skip {update.location.doc_name} update too old {update_age}")
+        else:
+            fresh_updates.append(update)
 
-        previously_notified = _find_last_notified(update["location"])
+    last_notified = _find_last_notified(u.location.doc_name for u in fresh_updates)
+    for update in fresh_updates:
+        location_name = update.location.doc_name
+        previously_notified = last_notified.get(location_name)
         if previously_notified is None:
-            logger.debug(f"Notify {update['location']}, never notified before")
+            logger.debug(f"Notify {location_name}, never notified before")
             yield update
             continue
 
-        delta_since_previous_update = update["date"] - previously_notified
+        delta_since_previous_update = update.date - previously_notified
         if delta_since_previous_update < timedelta(
             minutes=cfg.MIN_MINS_BETWEEN_UPDATES
         ):
             logger.debug(
-                f"Skip {update['location']} last notified {delta_since_previous_update} ago"
+                f"Skip {location_name} last notified {delta_since_previous_update} ago"
             )
         else:
             logger.debug(
-                f"Notify {update['location']}, previously {delta_since_previous_update} ago"
+                f"Notify {location_name}, previously {delta_since_previous_update} ago"
             )
             yield update
 
 
-def _find_last_notified(location):
-    """Find when an update for location was previously notified.
+def _find_last_notified(locations):
+    """Find when updates for locations were previously notified w/ bulk reads.
 
-    Returns notification time as datetime object or None if never notified.
+    Returns a dict of notification times as datetime objects by location,
+    locations never notified are left out.
     """
-    doc_ref = get_db().collection("locations").document(location)
-    doc = doc_ref.get()
-    if not doc.exists:
-        return None
-    else:
-        return doc.to_dict().get("last_notified")
-
-
-def _notify_one_update(update, tweet):
-    """Notify one update."""
-    ok = _send_notification(update, tweet)
-    if ok:
-        _save_notification_time(update)
-
-
-def _send_notification(update, tweet):
-    """Send notification for an update."""
-    return tweet_update(update, not tweet)
+    return get_storage().load_last_notified(locations)
 
 
-def _save_notification_time(update):
-    """Save notification time of an update into firestore db."""
-    doc_ref = get_db().collection("locations").document(update["location"])
-    doc_ref.set({"last_notified": update["date"]}, merge=True)
+def _save_notification_times(updates):
+    """Save notification times of updates into db w/ bulk writes."""
+    last_notified = {update.location.doc_name: update.date for update in updates}
+    if last_notified:
+        get_storage().save_last_notified(last_notified)
@@ -0,0 +1,121 @@
+"""Durable outbox for notifications.
+
+- enqueue rendered tweets w/ idempotency keys into storage
+- drain: claim pending messages, send them, acknowledge in batches
+  - retry failed messages w/ exponential backoff
+  - give up after max attempts
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone
+
+from latubot import cfg, metrics
+from latubot.storage.api import get_storage
+from latubot.tweet import render_tweet, tweet_messages
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(updates):
+    """Queue notifications for updates, return updates queued now.
+
+    Updates w/o a twitter account and updates already in the outbox are
+    skipped.
+    """
+    now = datetime.now(timezone.utc)
+    messages = {}
+    updates_by_id = {}
+    for update in updates:
+        message = render_tweet(update)
+        if message is None:
+            logger.debug(f"Skip {update.location.doc_name}, no twitter account")
+            continue
+
+        id_ = message_id(update)
+        messages[id_] = {
+            **message,
+            "location": update.location.doc_name,
+            "date": update.date,
+            "state": "pending",
+            "attempts": 0,
+            "next_attempt": now,
+        }
+        updates_by_id[id_] = update
+
+    if not messages:
+        return []
+
+    with metrics.timer("stage", stage="enqueue"):
+        queued = get_storage().enqueue_messages(messages)
+    logger.info(f"Queued {len(queued)}/{len(messages)} notifications")
+    return [updates_by_id[id_] for id_ in queued]
+
+
+@metrics.summarized
+def drain(tweet=False, n=None, ids=None):
+    """Send at most n pending notifications, return number of sent ones.
+
+    Messages are claimed before sending, so that concurrent drains don't
+    send them twice.
+
+    ids: send only messages w/ these ids, e.g. just queued ones, all of
+      them if n is not given
+
+    W/o tweet, tweets are only logged. Then w/o ids pending messages are
+    left pending, w/ ids the messages are marked sent.
+    """
+    now = datetime.now(timezone.utc)
+    storage = get_storage()
+    if ids is None:
+        pending = storage.find_pending_messages(now, n or cfg.OUTBOX_DRAIN_SIZE)
+        if not tweet:
+            for _ in tweet_messages(pending.items(), True):
+                pass
+            logger.info(f"Pretended to send {len(pending)} pending notifications")
+            return 0
+        ids = list(pending)
+
+    ids = list(ids)[:n] if n else ids
+    lease = now + timedelta(seconds=cfg.OUTBOX_LEASE_SECS)
+    pending = storage.claim_messages(ids, now, lease)
+
+    sent = failed = 0
+    changes = {}
+    try:
+        for id_, ok in tweet_messages(pending.items(), not tweet):
+            changes[id_] = _next_state(pending[id_], ok, now)
+            if ok:
+                sent += 1
+            elif changes[id_]["state"] == "failed":
+                failed += 1
+            if len(changes) >= cfg.OUTBOX_ACK_BATCH:
+                storage.update_messages(changes)
+                changes = {}
+    finally:
+        if changes:
+            storage.update_messages(changes)
+
+    retried = len(pending) - sent - failed
+    logger.info(
+        f"Sent {sent}/{len(pending)} notifications, {retried} to retry, {failed} failed"
+    )
+    return sent
+
+
+def _next_state(message, ok, now):
+    """Message state after a send attempt."""
+    attempts = message["attempts"] + 1
+    if ok:
+        return {"state": "sent", "attempts": attempts, "next_attempt": None}
+
+    if attempts >= cfg.OUTBOX_MAX_ATTEMPTS:
+        logger.error(f"Give up sending after {attempts} attempts: {message['msg']}")
+        return {"state": "failed", "attempts": attempts, "next_attempt": None}
+
+    delay = timedelta(seconds=cfg.OUTBOX_RETRY_SECS * 2 ** (attempts - 1))
+    return {"state": "pending", "attempts": attempts, "next_attempt": now + delay}
+
+
+def message_id(update):
+    """Idempotency key of an update notification, location and update time."""
+    return f"{update.location.doc_name}_{update.date.timestamp()}"
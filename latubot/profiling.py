@@ -0,0 +1,79 @@
+"""Profile cpu time and memory allocations of a block.
+
+    with Profile() as p:
+        load_updates()
+    p.save("load")  # load.prof for pstats/snakeviz, load.txt hot spots
+
+Report lists functions by own and cumulative time, latubot functions, and
+lines allocating most memory. cProfile records only the calling thread, so
+e.g. areas are loaded serially while profiling, see active.
+"""
+
+import io
+import logging
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# Number of recording profiles
+_active = 0
+
+
+def active():
+    """Whether a profile is recording, e.g. to run work in the calling thread."""
+    return _active > 0
+
+
+class Profile:
+    """Context manager recording a cpu profile and an allocation snapshot."""
+
+    def __init__(self, n=30):
+        import cProfile
+
+        self.n = n
+        self.report = None
+        self._profiler = cProfile.Profile()
+
+    def __enter__(self):
+        global _active
+        _active += 1
+        tracemalloc.start()
+        self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        self._profiler.disable()
+        _active -= 1
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.report = self._report(snapshot, peak)
+
+    def save(self, prefix):
+        """Write raw profile in prefix.prof and report in prefix.txt."""
+        self._profiler.dump_stats(f"{prefix}.prof")
+        with open(f"{prefix}.txt", "w") as f:
+            f.write(self.report)
+        logger.info(f"Saved profile in {prefix}.prof and {prefix}.txt")
+
+    def _report(self, snapshot, peak):
+        import pstats
+
+        out = io.StringIO()
+        stats = pstats.Stats(self._profiler, stream=out)
+        for title, sort_key, restrictions in (
+            ("Own time", pstats.SortKey.TIME, ()),
+            ("Cumulative time", pstats.SortKey.CUMULATIVE, ()),
+            ("Latubot functions", pstats.SortKey.CUMULATIVE, ("latubot",)),
+        ):
+            out.write(f"=== {title}\n")
+            stats.sort_stats(sort_key).print_stats(*restrictions, self.n)
+
+        out.write(f"=== Allocations, peak {peak / 1024:.1f} KiB\n")
+        snapshot = snapshot.filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+        for stat in snapshot.statistics("lineno")[: self.n]:
+            out.write(f"{stat}\n")
+        return out.getvalue()
@@ -0,0 +1,111 @@
+"""Compact records of locations and status updates.
+
+Records are created once when parsing server responses w/ only the fields
+latubot uses, and converted from and to storage dicts at the edges. Area,
+group and type strings repeat across venues and are interned.
+"""
+
+import functools
+import hashlib
+import sys
+
+from latubot import cfg
+
+
+class Location:
+    """Location of a venue: area, venue type, group and name."""
+
+    __slots__ = ("area", "type", "group", "name", "_doc_name")
+
+    def __init__(self, area, type, group, name, doc_name=None):
+        self.area = area and sys.intern(area)
+        self.type = type and sys.intern(type)
+        self.group = group and sys.intern(group)
+        self.name = name
+        self._doc_name = doc_name
+
+    @property
+    def doc_name(self):
+        """Unique document name of the location in storage."""
+        if self._doc_name is None:
+            self._doc_name = _location_doc_name(
+                (self.area, self.type, self.group, self.name)
+            )
+        return self._doc_name
+
+    @classmethod
+    def from_dict(cls, d, doc_name=None):
+        """Location from a storage dict, extra keys are left out."""
+        return cls(
+            d.get("area"), d.get("type"), d.get("group"), d.get("name"), doc_name
+        )
+
+    def to_dict(self):
+        """Storage dict of the location."""
+        return {
+            "area": self.area,
+            "type": self.type,
+            "group": self.group,
+            "name": self.name,
+        }
+
+    def __repr__(self):
+        return f"Location({self.area!r}, {self.type!r}, {self.group!r}, {self.name!r})"
+
+
+class Update:
+    """Status update of a venue.
+
+    id is the venue id in the source, None for updates from storage.
+    """
+
+    __slots__ = ("location", "date", "status", "description", "id")
+
+    def __init__(self, location, date, status, description, id=None):
+        self.location = location
+        self.date = date
+        self.status = status
+        self.description = description
+        self.id = id
+
+    @classmethod
+    def from_status(cls, status, location):
+        """Update from a storage status dict and its location."""
+        return cls(
+            location, status["date"], status.get("status"), status.get("description")
+        )
+
+    def to_status(self):
+        """Storage status dict, w/ the location document name."""
+        return {
+            "date": self.date,
+            "status": self.status,
+            "description": self.description,
+            "location": self.location.doc_name,
+        }
+
+    def to_dict(self):
+        """Flat dict of the update and its location, e.g. to dump as json."""
+        return {
+            **self.location.to_dict(),
+            "id": self.id,
+            "date": self.date,
+            "status": self.status,
+            "description": self.description,
+        }
+
+    def __repr__(self):
+        return f"Update({self.location!r}, {self.date!r}, {self.status!r})"
+
+
+@functools.lru_cache(maxsize=cfg.LOCATION_CACHE_SIZE)
+def _location_doc_name(values):
+    """Document name of a location, sha256 based like in existing documents.
+
+    Memoized as the same locations are seen on every load.
+    """
+    m = hashlib.sha256()
+    for item in values:
+        m.update(item.encode())
+        m.update(b"\xc0")
+    return m.hexdigest()[:8]
@@ -28,37 +28,62 @@ def area_names():
     return kunto.ALL_AREAS
 
 
+def http_cache_stats():
+    """Data source http cache hit and miss counts."""
+    return kunto.http_cache_stats()
+
+
 def load(sport, area, since=None, fn=None):
     """Load updates."""
     sport = sport.lower()
-    if sport not in sport_names():
-        raise ValueError(f"Invalid sport {sport}")
+    return load_area(area, (sport,), since, fn)[sport]
 
-    area = area.upper()
-    if area not in area_names():
-        raise ValueError(f"Invalid area {area}")
 
-    # if new data sources are added, unify and combine data here
-    data = kunto.load(sport, area, fn=fn)
+def save_http_cache(validators):
+    """Save http cache validators collected by load_area."""
+    kunto.save_http_cache(validators)
 
-    if since:
-        data = filter(_time_filter(since), data)
 
-    return list(data)
+def load_area(area, sports=None, since=None, fn=None, validators=None):
+    """Load updates for sports in an area, return a dict of updates by sport.
 
+    Area data is loaded only once regardless of the number of sports.
 
-def _time_filter(since):
-    """Filter function to pass only items w/ date not older than since."""
-    delta = time_utils.since_to_delta(since)
-    now = datetime.now(tzutc())
+    validators: dict to collect http cache validators, to save w/
+      save_http_cache once the updates are saved. Nothing is returned if
+      data is not modified since validators of the same area, sports and
+      since were saved. Data is always loaded if None.
+    """
+    sports = tuple(sport.lower() for sport in sports or sport_names())
+    for sport in sports:
+        if sport not in sport_names():
+            raise ValueError(f"Invalid sport {sport}")
 
-    def f(v):
-        try:
-            return v["date"] and now - delta < v["date"]
-        except KeyError:
-            return False
+    area = area.upper()
+    if area not in area_names():
+        raise ValueError(f"Invalid area {area}")
+
+    earliest = _earliest(since) if since else None
 
-    return f
+    cache_key = None
+    if validators is not None:
+        cache_key = f"{area}/{'+'.join(sorted(sports))}/{since or ''}"
+
+    # if new data sources are added, unify and combine data here
+    return kunto.load_area(
+        area,
+        sports,
+        fn=fn,
+        earliest=earliest,
+        cache_key=cache_key,
+        validators=validators,
+    )
+
+
+def _earliest(since):
+    """Earliest date of items not older than since."""
+    delta = time_utils.since_to_delta(since)
+    return datetime.now(tzutc()) - delta
 
 
 if __name__ == "__main__":
@@ -67,6 +92,6 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
     fn = sys.argv[1] if len(sys.argv) > 1 else None
-    d1 = load(sport="latu", area="OULU", since="7M", fn=fn)
+    d1 = [u.to_dict() for u in load(sport="latu", area="OULU", since="7M", fn=fn)]
     logger.debug(f"Loaded {len(d1)} updates")
     print(json.dumps(d1, cls=time_utils.DateTimeEncoder, indent=2))
@@ -0,0 +1,131 @@
+"""Content-addressed archive of raw venue list responses.
+
+- <root>/objects/<sha256[:2]>/<sha256>.gz: a response, gzip compressed,
+  saved once however many times it's fetched
+- <root>/index/<area>.idx: (fetch time, sha256) records of an area in
+  fetch order, fixed size
+
+Indexes are memory-mapped and searched by fetch time, only the found
+response is decompressed.
+"""
+
+import gzip
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Index record: fetch time as utc timestamp, sha256 digest of the response
+_RECORD = struct.Struct("<d32s")
+_index_lock = threading.Lock()
+
+
+def save(root, area, data, fetched_at=None, digest=None):
+    """Archive a response of an area, return its sha256 hex digest.
+
+    data: response bytes
+    fetched_at: fetch time (tz aware datetime), now by default
+    digest: sha256 hex digest of data if already calculated
+    """
+    digest = digest or hashlib.sha256(data).hexdigest()
+    fetched_at = fetched_at or datetime.now(timezone.utc)
+
+    fn = _object_fn(root, digest)
+    if not os.path.exists(fn):
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp_fn = f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_fn, "wb") as f:
+            f.write(gzip.compress(data))
+        os.replace(tmp_fn, fn)
+        logger.debug(f"Archived {area} response {digest} ({len(data)} bytes)")
+
+    record = _RECORD.pack(fetched_at.timestamp(), bytes.fromhex(digest))
+    with _index_lock:
+        os.makedirs(os.path.join(root, "index"), exist_ok=True)
+        with open(_index_fn(root, area), "ab") as f:
+            # drop a partly written record, so that new ones stay aligned
+            size = os.fstat(f.fileno()).st_size
+            if size % _RECORD.size:
+                f.truncate(size - size % _RECORD.size)
+            f.write(record)
+    return digest
+
+
+def load(root, area, at=None):
+    """Load the last response of an area fetched at or before at.
+
+    Latest response if at is None. Returns (fetch time, response bytes),
+    None if there is no such response.
+    """
+    found = find(root, area, at)
+    if found is None:
+        return None
+
+    fetched_at, digest = found
+    with gzip.open(_object_fn(root, digest)) as f:
+        return fetched_at, f.read()
+
+
+def find(root, area, at=None):
+    """Find the last response of an area fetched at or before at.
+
+    Returns (fetch time, sha256 hex digest), None if not found.
+    """
+    try:
+        with _Index(_index_fn(root, area)) as index:
+            i = len(index) if at is None else index.bisect(at.timestamp())
+            return index[i - 1] if i else None
+    except FileNotFoundError:
+        return None
+
+
+class _Index:
+    """Memory-mapped index file of an area."""
+
+    def __init__(self, fn):
+        self._f = open(fn, "rb")
+        size = os.fstat(self._f.fileno()).st_size
+        self._mm = (
+            mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        )
+        # ignore a partly written record at the end
+        self._n = size // _RECORD.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._mm:
+            self._mm.close()
+        self._f.close()
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        timestamp, digest = _RECORD.unpack_from(self._mm, i * _RECORD.size)
+        return datetime.fromtimestamp(timestamp, timezone.utc), digest.hex()
+
+    def bisect(self, timestamp):
+        """Number of records fetched at or before timestamp."""
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _RECORD.unpack_from(self._mm, mid * _RECORD.size)[0] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def _object_fn(root, digest):
+    return os.path.join(root, "objects", digest[:2], f"{digest}.gz")
+
+
+def _index_fn(root, area):
+    return os.path.join(root, "index", f"{area}.idx")
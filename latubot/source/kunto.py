@@ -2,11 +2,20 @@
 
 import logging
 import json
+import os
+import re
+import hashlib
+import threading
+import functools
+from collections import Counter
+from datetime import datetime, timedelta
 
 import requests
-import dateutil.parser
+from requests.adapters import HTTPAdapter
 
-from latubot import time_utils
+from latubot import cfg, metrics, time_utils
+from latubot.records import Location, Update
+from latubot.source import archive
 
 logger = logging.getLogger(__name__)
 
@@ -45,38 +54,222 @@ _DEFAULT_AREA = "OULU"
 _DEFAULT_SPORT = "latu"
 _URL_TEMPLATE = "https://{area}.fluentprogress.fi/outdoors/"
 
+_session = None
+_session_lock = threading.Lock()
 
-def load(sport: str = _DEFAULT_SPORT, area: str = _DEFAULT_AREA, fn=None):
+# http cache validators by cache key: {"etag", "last_modified", "hash"}
+_http_cache = None
+_http_cache_stats = Counter()
+_http_cache_lock = threading.Lock()
+
+
+_SPORT_MAP = {"latu": "skitrack", "luistelu": "skatefield"}
+
+
+def load(sport: str = _DEFAULT_SPORT, area: str = _DEFAULT_AREA, fn=None, at=None):
     """Load data for (sport, area) combo."""
-    if sport not in ALL_SPORTS:
-        raise ValueError(f"invalid sport {sport!r}")
+    return load_area(area, (sport,), fn=fn, at=at)[sport]
+
+
+def load_area(
+    area: str = _DEFAULT_AREA,
+    sports=ALL_SPORTS,
+    fn=None,
+    earliest=None,
+    at=None,
+    cache_key=None,
+    validators=None,
+):
+    """Load data for all sports in an area.
+
+    Data for an area is fetched and parsed once, returns a dict of updates
+    (records.Update) by sport. If earliest (tz aware datetime) is given, only updates
+    maintained after it are returned.
+
+    fn: file to load data from instead of the server, or a raw archive
+      directory (see cfg.RAW_ARCHIVE) to load the data of area fetched last
+      at or before at (tz aware datetime), latest if at is None
+    cache_key: key of http cache validators identifying the request, e.g.
+      area, sports and since. Nothing is returned if the response is not
+      modified since validators were saved under the key. Data is always
+      loaded if None.
+    validators: dict to collect new validators by cache_key, to save w/
+      save_http_cache once the updates are saved
+    """
+    for sport in sports:
+        if sport not in ALL_SPORTS:
+            raise ValueError(f"invalid sport {sport!r}")
 
     if area not in ALL_AREAS:
         raise ValueError(f"invalid area {area!r}")
 
-    if fn:
+    entry = None
+    if fn and os.path.isdir(fn):
+        raw = _load_archived_data(fn, area, at)
+    elif fn:
         logger.debug(f"Load updates from {fn}")
         raw = open(fn).read()
     else:
-        raw = _load_raw_data(area)
+        raw, entry = _load_raw_data(area, cache_key)
+
+    if raw is None:
+        logger.info(f"No changes in {area} since previous load")
+        return {sport: [] for sport in sports}
 
-    updates = _parse(raw, sport)
+    with metrics.timer("stage", stage="parse"):
+        updates = _parse_sports(raw, sports, earliest, area)
+    if entry and cache_key and validators is not None:
+        validators[cache_key] = entry
 
-    _log_updates(updates)
+    for sport, sport_updates in updates.items():
+        _log_updates(sport_updates, sport, area)
     return updates
 
 
-def _load_raw_data(area):
-    """Load raw data from kunto server."""
+def _load_raw_data(area, cache_key=None):
+    """Load raw data from kunto server.
+
+    Sends a conditional request w/ validators saved under cache_key, if
+    given. Returns (data, new validators), data is None if not modified
+    since the validators were saved.
+    """
     base_url = _URL_TEMPLATE.format(area=area.lower())
     url = base_url + "api/venue/list"
-    resp = requests.get(url)
+    cached = _get_http_cache().get(cache_key, {}) if cache_key else {}
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    with metrics.timer("fetch", area=area):
+        resp = _get_session().get(url, headers=headers, timeout=cfg.FETCH_TIMEOUT)
+    metrics.inc("fetch_bytes_total", len(resp.content), area=area)
+    if resp.status_code == 304:
+        metrics.inc("fetch_total", area=area, result="not_modified")
+        _count_http_cache("hit")
+        return None, None
+
+    content_hash = hashlib.sha256(resp.content).hexdigest()
+    if resp.ok and cfg.RAW_ARCHIVE:
+        _archive_raw_data(area, resp.content, content_hash)
+
+    if resp.ok and content_hash == cached.get("hash"):
+        metrics.inc("fetch_total", area=area, result="unchanged")
+        _count_http_cache("hit")
+        return None, None
+
+    metrics.inc("fetch_total", area=area, result=resp.status_code)
+    resp.raise_for_status()
+
+    entry = {
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "hash": content_hash,
+    }
+    if cache_key:
+        _count_http_cache("miss")
+
     resp.encoding = "utf-8"
-    return resp.text
+    return resp.text, entry
+
+
+def _archive_raw_data(area, data, content_hash):
+    """Archive a response, see cfg.RAW_ARCHIVE."""
+    try:
+        archive.save(cfg.RAW_ARCHIVE, area, data, digest=content_hash)
+    except OSError as e:
+        logger.error(f"Can't archive {area} response in {cfg.RAW_ARCHIVE} ({e})")
+
+
+def _load_archived_data(root, area, at=None):
+    """Load archived raw data of area fetched last at or before at."""
+    archived = archive.load(root, area, at)
+    if archived is None:
+        raise ValueError(f"no archived data for {area!r} at {at} in {root}")
+
+    fetched_at, data = archived
+    logger.debug(f"Load updates for {area} fetched at {fetched_at} from {root}")
+    return data.decode("utf-8")
+
+
+def _get_http_cache():
+    """Lazy init http cache, load persisted validators if configured."""
+    global _http_cache
+    with _http_cache_lock:
+        if _http_cache is None:
+            _http_cache = {}
+            if cfg.HTTP_CACHE_FN:
+                try:
+                    with open(cfg.HTTP_CACHE_FN) as f:
+                        _http_cache = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.info(f"No http cache loaded from {cfg.HTTP_CACHE_FN} ({e})")
+    return _http_cache
+
+
+def _count_http_cache(result):
+    """Count a cache "hit" or "miss"."""
+    with _http_cache_lock:
+        _http_cache_stats[result] += 1
+
 
+def save_http_cache(validators):
+    """Save new http cache validators by cache key, see load_area."""
+    if not validators:
+        return
 
-def _parse(txt, sport):
-    """Parse server response for updates on sport.
+    _get_http_cache()
+    with _http_cache_lock:
+        _http_cache.update(validators)
+        if cfg.HTTP_CACHE_FN:
+            try:
+                with open(cfg.HTTP_CACHE_FN, "w") as f:
+                    json.dump(_http_cache, f)
+            except OSError as e:
+                logger.error(f"Can't save http cache in {cfg.HTTP_CACHE_FN} ({e})")
+
+
+def http_cache_stats():
+    """Get http cache hit and miss counts."""
+    with _http_cache_lock:
+        return {"hit": _http_cache_stats["hit"], "miss": _http_cache_stats["miss"]}
+
+
+def _get_session():
+    """Lazy init http session shared by all fetches.
+
+    Each area is served from its own host, keep a connection pool per host so
+    that concurrent fetches can reuse connections.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=len(ALL_AREAS))
+            session = requests.Session()
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def _parse_sports(txt, sports, earliest=None, area=None):
+    """Parse server response for updates on sports in one pass.
+
+    Returns a dict of updates by sport.
+    """
+    sport_updates = {sport: [] for sport in sports}
+    for sport, v in _gen_updates(txt, sports, earliest, area):
+        sport_updates[sport].append(v)
+    return sport_updates
+
+
+def _gen_updates(txt, sports, earliest=None, area=None):
+    """Generate (sport, update) tuples from server response.
+
+    Features are decoded one at a time. Features of other types and, if
+    earliest is given, features maintained before it are discarded before
+    parsing dates. Updates are records w/ only the used properties, e.g.
+    images are dropped.
 
     txt: {
         "type": "FeatureCollection",
@@ -95,32 +288,81 @@ def _parse(txt, sport):
         }
     }
     """
-    sport_map = {"latu": "skitrack", "luistelu": "skatefield"}
-    d = json.loads(txt)
-    updates = (f["properties"] for f in d["features"])
-    sport_updates = [v for v in updates if v["type"] == sport_map[sport]]
+    types = {_SPORT_MAP[sport]: sport for sport in sports}
+    # maintainedAt starts w/ local date, compare dates w/ a day of margin to
+    # cover any utc offset before exact comparison of parsed dates
+    earliest_day = earliest and (earliest - timedelta(days=1)).date().isoformat()
+    for f in _gen_features(txt):
+        v = f["properties"]
+        sport = types.get(v["type"])
+        if sport is None:
+            continue
 
-    for v in sport_updates:
-        v["date"] = _parse_maintained_at(v.pop("maintainedAt", None))
+        maintained_at = v.get("maintainedAt")
+        if earliest_day and (maintained_at or "")[:10] < earliest_day:
+            continue
 
-    return sport_updates
+        date = _parse_maintained_at(maintained_at)
+        if earliest and not (date and earliest < date):
+            continue
+
+        location = Location(area, v["type"], v.get("group"), v.get("name"))
+        yield sport, Update(
+            location, date, v.get("status"), v.get("description"), v.get("id")
+        )
+
+
+_FEATURES_RE = re.compile(r'"features"\s*:\s*\[')
+_SEPARATOR_RE = re.compile(r"[\s,]*")
+
+
+def _gen_features(txt):
+    """Generate features from a FeatureCollection one at a time."""
+    m = _FEATURES_RE.search(txt)
+    if m is None:
+        yield from json.loads(txt)["features"]
+        return
+
+    decoder = json.JSONDecoder()
+    pos = m.end()
+    while True:
+        pos = _SEPARATOR_RE.match(txt, pos).end()
+        if txt[pos] == "]":
+            return
+        feature, pos = decoder.raw_decode(txt, pos)
+        yield feature
 
 
 def _parse_maintained_at(v):
     """Parse maintainedAt value from an update."""
     try:
-        return dateutil.parser.isoparse(v)
+        return _parse_datetime(v)
     except Exception as e:
         if v:
             logger.error(f"Can't parse date from {v!r} ({e})")
         return None
 
 
-def _log_updates(updates):
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime(v):
+    """Parse an iso 8601 datetime, memoized.
+
+    Fast path for the fixed format fluentprogress emits
+    ("2020-03-20T06:50:54.031+02:00"), dateutil for anything else.
+    """
+    try:
+        return datetime.fromisoformat(v)
+    except (TypeError, ValueError):
+        import dateutil.parser
+
+        return dateutil.parser.isoparse(v)
+
+
+def _log_updates(updates, sport, area):
     """Log updates."""
     n = len(updates)
-    n_with_date = sum(1 for v in updates if v["date"])
-    logger.info(f"Loaded {n} items ({n_with_date} w/ date)")
+    n_with_date = sum(1 for v in updates if v.date)
+    logger.info(f"Loaded {n} {sport} items in {area} ({n_with_date} w/ date)")
 
 
 if __name__ == "__main__":
@@ -128,5 +370,6 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=logging.DEBUG)
     fn = sys.argv[1] if len(sys.argv) > 1 else None
-    d1 = load(sport="latu", fn=fn)
+    at = datetime.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else None
+    d1 = [update.to_dict() for update in load(sport="latu", fn=fn, at=at)]
     print(json.dumps(d1, cls=time_utils.DateTimeEncoder, indent=2))
@@ -0,0 +1,74 @@
+"""API for latubot storage
+
+Storage backend is selected w/ a spec string:
+
+- "firestore": google cloud firestore
+- "sqlite:<path>": sqlite database in a local file
+- "memory": sqlite database in memory
+"""
+
+import functools
+import logging
+
+from latubot import cfg, metrics
+
+storage = None
+logger = logging.getLogger(__name__)
+
+
+def get_storage():
+    """Lazy init storage from cfg.STORAGE."""
+    if storage is None:
+        init_storage(cfg.STORAGE)
+    return storage
+
+
+def init_storage(spec):
+    """Initialize storage from a spec string."""
+    global storage
+    logger.info(f"Initialize {spec} storage")
+    storage = MeasuredStorage(create_storage(spec))
+    return storage
+
+
+def create_storage(spec):
+    """Create storage from a spec string."""
+    if spec == "firestore":
+        from latubot.storage.firestore import FirestoreStorage
+
+        return FirestoreStorage()
+
+    if spec == "memory":
+        from latubot.storage.sqlite import SQLiteStorage
+
+        return SQLiteStorage(":memory:")
+
+    if spec.startswith("sqlite:"):
+        from latubot.storage.sqlite import SQLiteStorage
+
+        return SQLiteStorage(spec[len("sqlite:") :])
+
+    raise ValueError(f"Invalid storage {spec!r}")
+
+
+class MeasuredStorage:
+    """Storage proxy timing and counting storage operations."""
+
+    _WRITE_PREFIXES = ("save_", "enqueue_", "claim_", "update_")
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if not callable(attr):
+            return attr
+
+        kind = "write" if name.startswith(self._WRITE_PREFIXES) else "read"
+
+        @functools.wraps(attr)
+        def f(*args, **kwargs):
+            with metrics.timer("db", op=name, kind=kind):
+                return attr(*args, **kwargs)
+
+        return f
@@ -0,0 +1,127 @@
+"""Storage interface.
+
+Data model:
+
+- location: {"area", "type", "group", "name", "last_notified"} by location
+  name
+- status update: {"date", "status", "description", "location"} by
+  (location name, status name)
+- latest status: newest status update of a location, by area and location
+  name
+- outbox message: {"type", "area", "msg", "location", "date", "state",
+  "attempts", "next_attempt"} by message id, state is "pending", "sent" or
+  "failed"
+- blob: bytes by name, e.g. snapshots of in-process caches
+"""
+
+
+class InvalidCursor(ValueError):
+    """Malformed cursor or a cursor of a missing status update."""
+
+
+def split_cursor(cursor):
+    """Split a "<location name>/<status name>" cursor, InvalidCursor if malformed."""
+    parts = cursor.split("/")
+    if len(parts) != 2 or not all(parts):
+        raise InvalidCursor(f"Invalid cursor {cursor!r}")
+    return tuple(parts)
+
+
+class Storage:
+    """Storage for locations, status updates and notification times."""
+
+    def save_locations(self, locations):
+        """Save locations that don't exist yet, locations by name."""
+        raise NotImplementedError
+
+    def save_statuses(self, statuses):
+        """Save status updates that don't exist yet.
+
+        statuses: {(location name, status name): status}, returns keys of
+        saved status updates.
+        """
+        raise NotImplementedError
+
+    def load_locations(self, names):
+        """Load locations by name, missing locations are left out."""
+        raise NotImplementedError
+
+    def load_all_locations(self):
+        """Load all locations, returns a dict of locations by name."""
+        raise NotImplementedError
+
+    def find_updates_since(self, earliest):
+        """Generate status updates w/ date after earliest."""
+        raise NotImplementedError
+
+    def find_latest_updates(self, locations=None, n=10, cursor=None):
+        """Find a page of latest status updates, newest first.
+
+        locations: location names to limit to, all locations if None
+        cursor: cursor of the previous page
+
+        Returns (status updates, cursor of next page or None), raises
+        InvalidCursor if the cursor is malformed or its update is missing.
+        """
+        raise NotImplementedError
+
+    def save_latest(self, statuses):
+        """Save latest status updates if newer than the saved ones.
+
+        statuses: {(area, location name): status}
+        """
+        raise NotImplementedError
+
+    def find_latest(self, earliest=None, areas=None):
+        """Find latest status updates of locations w/ date after earliest.
+
+        Returns a list of status updates, one per location, limited to
+        areas if given.
+        """
+        raise NotImplementedError
+
+    def load_last_notified(self, locations):
+        """Load last notification times by location name.
+
+        Locations never notified are left out.
+        """
+        raise NotImplementedError
+
+    def save_last_notified(self, last_notified):
+        """Save last notification times by location name."""
+        raise NotImplementedError
+
+    def enqueue_messages(self, messages):
+        """Save outbox messages that don't exist yet, messages by id.
+
+        Returns ids of saved messages.
+        """
+        raise NotImplementedError
+
+    def find_pending_messages(self, now, n=100):
+        """Find at most n pending outbox messages due before now.
+
+        Returns a dict of messages by id, oldest due first.
+        """
+        raise NotImplementedError
+
+    def claim_messages(self, ids, now, until):
+        """Claim messages still pending and due before now for sending.
+
+        Claimed messages are leased by moving their next attempt to until,
+        so that concurrent drains skip them. Returns a dict of claimed
+        messages by id.
+        """
+        raise NotImplementedError
+
+    def update_messages(self, messages):
+        """Update "state", "attempts" and "next_attempt" of messages by id."""
+        raise NotImplementedError
+
+    def load_blob(self, name):
+        """Load a blob by name, None if it doesn't exist."""
+        raise NotImplementedError
+
+    def save_blob(self, name, data):
+        """Save a blob by name."""
+        raise NotImplementedError
@@ -0,0 +1,259 @@
+"""Google cloud firestore storage.
+
+- locations/<location name>: location
+- locations/<location name>/updates/<status name>: status update
+- areas/<area>: {"latest": {location name: latest status}}
+- outbox/<message id>: outbox message
+- cache/<name>: {"data": blob}
+"""
+
+import heapq
+import logging
+from collections import defaultdict
+
+from google.cloud import firestore
+
+from latubot import gcloud, metrics
+from latubot.gcloud import get_db
+from latubot.storage.base import InvalidCursor, Storage, split_cursor
+
+logger = logging.getLogger(__name__)
+
+# Max number of values in a firestore "in" query
+_MAX_IN_VALUES = 10
+# Max number of "in" queries for a page, more locations are scanned for
+_MAX_IN_QUERIES = 3
+
+
+class FirestoreStorage(Storage):
+    """Storage in google cloud firestore."""
+
+    def save_locations(self, locations):
+        collection = get_db().collection("locations")
+        docs = {collection.document(name): v for name, v in locations.items()}
+        gcloud.write(_find_missing(docs))
+
+    def save_statuses(self, statuses):
+        collection = get_db().collection("locations")
+        docs = {
+            collection.document(location_name).collection("updates").document(name): v
+            for (location_name, name), v in statuses.items()
+        }
+        new_docs = _find_missing(docs)
+        gcloud.write(new_docs)
+        return [(ref.parent.parent.id, ref.id) for ref, _ in new_docs]
+
+    def load_locations(self, names):
+        collection = get_db().collection("locations")
+        docs = gcloud.get_all(collection.document(name) for name in set(names))
+        return {doc.id: doc.to_dict() for doc in docs if doc.exists}
+
+    def load_all_locations(self):
+        docs = get_db().collection("locations").stream()
+        return {doc.id: doc.to_dict() for doc in docs}
+
+    def find_updates_since(self, earliest):
+        query = get_db().collection_group("updates").where("date", ">", earliest)
+        return (doc.to_dict() for doc in query.stream())
+
+    def find_latest_updates(self, locations=None, n=10, cursor=None):
+        start_after = _cursor_to_snapshot(cursor) if cursor else None
+        docs = _find_latest_updates(locations, n, start_after)
+        next_cursor = _snapshot_to_cursor(docs[-1]) if len(docs) == n else None
+        return [doc.to_dict() for doc in docs], next_cursor
+
+    def save_latest(self, statuses):
+        db = get_db()
+        collection = db.collection("areas")
+        by_area = defaultdict(dict)
+        for (area, name), status in statuses.items():
+            by_area[area][name] = status
+
+        @firestore.transactional
+        def save(transaction, refs):
+            written = 0
+            for doc in transaction.get_all(refs):
+                saved = doc.to_dict().get("latest", {}) if doc.exists else {}
+                newer = {
+                    name: status
+                    for name, status in by_area[doc.id].items()
+                    if name not in saved or saved[name]["date"] < status["date"]
+                }
+                if newer:
+                    transaction.set(doc.reference, {"latest": newer}, merge=True)
+                    written += 1
+            return written
+
+        refs = (collection.document(area) for area in by_area)
+        for chunk in gcloud.chunks(refs, gcloud.MAX_BATCH_SIZE):
+            metrics.inc("firestore_documents_total", len(chunk), op="read")
+            written = save(db.transaction(), chunk)
+            metrics.inc("firestore_documents_total", written, op="write")
+
+    def find_latest(self, earliest=None, areas=None):
+        return [
+            status
+            for latest in _load_latest(areas).values()
+            for status in latest.values()
+            if earliest is None or status["date"] > earliest
+        ]
+
+    def load_last_notified(self, locations):
+        last_notified = {}
+        for name, location in self.load_locations(locations).items():
+            if location.get("last_notified") is not None:
+                last_notified[name] = location["last_notified"]
+        return last_notified
+
+    def save_last_notified(self, last_notified):
+        collection = get_db().collection("locations")
+        items = (
+            (collection.document(name), {"last_notified": date})
+            for name, date in last_notified.items()
+        )
+        gcloud.write(items, merge=True)
+
+    def enqueue_messages(self, messages):
+        collection = get_db().collection("outbox")
+        docs = {collection.document(id_): v for id_, v in messages.items()}
+        new_docs = _find_missing(docs)
+        gcloud.write(new_docs)
+        return [ref.id for ref, _ in new_docs]
+
+    def find_pending_messages(self, now, n=100):
+        query = (
+            get_db()
+            .collection("outbox")
+            .where("state", "==", "pending")
+            .where("next_attempt", "<=", now)
+            .order_by("next_attempt")
+            .limit(n)
+        )
+        return {doc.id: doc.to_dict() for doc in query.stream()}
+
+    def claim_messages(self, ids, now, until):
+        db = get_db()
+        collection = db.collection("outbox")
+
+        @firestore.transactional
+        def claim(transaction, refs):
+            claimed = {}
+            for doc in transaction.get_all(refs):
+                message = doc.to_dict() if doc.exists else {}
+                if message.get("state") != "pending":
+                    continue
+                if message["next_attempt"] <= now:
+                    transaction.update(doc.reference, {"next_attempt": until})
+                    claimed[doc.id] = {**message, "next_attempt": until}
+            return claimed
+
+        claimed = {}
+        refs = (collection.document(id_) for id_ in ids)
+        for chunk in gcloud.chunks(refs, gcloud.MAX_BATCH_SIZE):
+            metrics.inc("firestore_documents_total", len(chunk), op="read")
+            chunk_claimed = claim(db.transaction(), chunk)
+            metrics.inc("firestore_documents_total", len(chunk_claimed), op="write")
+            claimed.update(chunk_claimed)
+        return claimed
+
+    def update_messages(self, messages):
+        collection = get_db().collection("outbox")
+        items = ((collection.document(id_), v) for id_, v in messages.items())
+        gcloud.write(items, merge=True)
+
+    def load_blob(self, name):
+        doc = get_db().collection("cache").document(name).get()
+        return doc.to_dict()["data"] if doc.exists else None
+
+    def save_blob(self, name, data):
+        get_db().collection("cache").document(name).set({"data": data})
+
+
+def _load_latest(areas=None):
+    """Load latest statuses by location name by area, all areas if None."""
+    collection = get_db().collection("areas")
+    if areas is None:
+        docs = collection.stream()
+    else:
+        docs = gcloud.get_all(collection.document(area) for area in set(areas))
+    return {doc.id: doc.to_dict().get("latest", {}) for doc in docs if doc.exists}
+
+
+def _find_missing(docs):
+    """Find documents that don't exist in db w/ batched reads.
+
+    docs: {document reference: data}, returns a list of (reference, data)
+    """
+    existing = {doc.reference.path for doc in gcloud.get_all(docs) if doc.exists}
+    return [(ref, data) for ref, data in docs.items() if ref.path not in existing]
+
+
+def _find_latest_updates(locations=None, n=10, start_after=None):
+    """Find at most n update document snapshots from firestore, newest first.
+
+    Limited to locations if given. Few locations are queried w/ an "in"
+    query per chunk of locations, each reading at most n documents, and the
+    results are merged by date like firestore orders them (date, then
+    document path). Many locations are filtered while scanning instead.
+    """
+    query = (
+        get_db()
+        .collection_group("updates")
+        .order_by("date", direction=firestore.Query.DESCENDING)
+    )
+    if locations is not None and len(locations) > _MAX_IN_VALUES * _MAX_IN_QUERIES:
+        return _scan_latest_updates(query, locations, n, start_after)
+
+    query = query.limit(n)
+    if start_after is not None:
+        query = query.start_after(start_after)
+
+    if locations is None:
+        queries = [query]
+    else:
+        names = sorted(locations)
+        queries = [
+            query.where("location", "in", names[i : i + _MAX_IN_VALUES])
+            for i in range(0, len(names), _MAX_IN_VALUES)
+        ]
+
+    pages = [list(q.stream()) for q in queries]
+    docs = heapq.merge(
+        *pages, key=lambda doc: (doc.get("date"), doc.reference.path), reverse=True
+    )
+    return list(docs)[:n]
+
+
+def _scan_latest_updates(query, locations, n, start_after=None):
+    """Find at most n update documents of locations in pages of n."""
+    docs = []
+    while True:
+        page_query = query.limit(n)
+        if start_after is not None:
+            page_query = page_query.start_after(start_after)
+
+        page = list(page_query.stream())
+        for doc in page:
+            if doc.get("location") in locations:
+                docs.append(doc)
+                if len(docs) == n:
+                    return docs
+
+        if len(page) < n:
+            return docs
+        start_after = page[-1]
+
+
+def _snapshot_to_cursor(doc):
+    """Cursor for the page after an update document: "<location>/<update>"."""
+    return f"{doc.reference.parent.parent.id}/{doc.id}"
+
+
+def _cursor_to_snapshot(cursor):
+    """Load update document snapshot from a cursor, InvalidCursor if missing."""
+    location, update = split_cursor(cursor)
+    locations = get_db().collection("locations")
+    doc = locations.document(location).collection("updates").document(update).get()
+    if not doc.exists:
+        raise InvalidCursor(f"No update for cursor {cursor!r}")
+    return doc
@@ -0,0 +1,327 @@
+"""SQLite storage, in a local file or in memory.
+
+Dates are stored as utc timestamps, and loaded as utc datetimes like from
+firestore.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from latubot.storage.base import InvalidCursor, Storage, split_cursor
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS locations (
+    location TEXT PRIMARY KEY,
+    area TEXT,
+    type TEXT,
+    "group" TEXT,
+    name TEXT,
+    last_notified REAL
+);
+CREATE TABLE IF NOT EXISTS updates (
+    location TEXT NOT NULL,
+    name TEXT NOT NULL,
+    date REAL NOT NULL,
+    status TEXT,
+    description TEXT,
+    PRIMARY KEY (location, name)
+);
+CREATE INDEX IF NOT EXISTS updates_date ON updates (date, location, name);
+CREATE INDEX IF NOT EXISTS updates_location_date ON updates (location, date);
+CREATE TABLE IF NOT EXISTS latest (
+    location TEXT PRIMARY KEY,
+    area TEXT NOT NULL,
+    date REAL NOT NULL,
+    status TEXT,
+    description TEXT
+);
+CREATE INDEX IF NOT EXISTS latest_area ON latest (area);
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    type TEXT,
+    area TEXT,
+    msg TEXT,
+    location TEXT,
+    date REAL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (state, next_attempt);
+CREATE TABLE IF NOT EXISTS blobs (
+    name TEXT PRIMARY KEY,
+    data BLOB
+);
+"""
+
+_LOCATION_COLUMNS = ("area", "type", "group", "name")
+_UPDATE_COLUMNS = ("date", "status", "description", "location")
+_MESSAGE_COLUMNS = (
+    "type",
+    "area",
+    "msg",
+    "location",
+    "date",
+    "state",
+    "attempts",
+    "next_attempt",
+)
+
+
+class SQLiteStorage(Storage):
+    """Storage in a sqlite database, fn ":memory:" for an in-memory db."""
+
+    def __init__(self, fn=":memory:"):
+        self.fn = fn
+        self._conn = sqlite3.connect(fn, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript(_SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _executemany(self, sql, params):
+        """Execute sql for each params in one transaction, return changed rows."""
+        with self._lock, self._conn:
+            changes = self._conn.total_changes
+            self._conn.executemany(sql, params)
+            return self._conn.total_changes - changes
+
+    def save_locations(self, locations):
+        self._executemany(
+            'INSERT OR IGNORE INTO locations (location, area, type, "group", name)'
+            " VALUES (?, ?, ?, ?, ?)",
+            (
+                (name, *(location.get(k) for k in _LOCATION_COLUMNS))
+                for name, location in locations.items()
+            ),
+        )
+
+    def save_statuses(self, statuses):
+        existing = self._execute(
+            "SELECT location, name FROM updates WHERE (location, name) IN ("
+            "SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]')"
+            " FROM json_each(?))",
+            (json.dumps(list(statuses)),),
+        )
+        existing = {(row["location"], row["name"]) for row in existing}
+        new = {k: v for k, v in statuses.items() if k not in existing}
+        self._executemany(
+            "INSERT OR IGNORE INTO updates"
+            " (location, name, date, status, description) VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    location_name,
+                    name,
+                    status["date"].timestamp(),
+                    status.get("status"),
+                    status.get("description"),
+                )
+                for (location_name, name), status in new.items()
+            ),
+        )
+        return list(new)
+
+    def load_locations(self, names):
+        rows = self._execute(
+            "SELECT * FROM locations WHERE location IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(set(names))),),
+        )
+        return {row["location"]: _location(row) for row in rows}
+
+    def load_all_locations(self):
+        rows = self._execute("SELECT * FROM locations")
+        return {row["location"]: _location(row) for row in rows}
+
+    def find_updates_since(self, earliest):
+        rows = self._execute(
+            "SELECT * FROM updates WHERE date > ?", (earliest.timestamp(),)
+        )
+        return (_update(row) for row in rows)
+
+    def find_latest_updates(self, locations=None, n=10, cursor=None):
+        where = []
+        params = []
+        if locations is not None:
+            where.append("location IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(locations)))
+        if cursor:
+            location, name = split_cursor(cursor)
+            rows = self._execute(
+                "SELECT date FROM updates WHERE location = ? AND name = ?",
+                (location, name),
+            )
+            if not rows:
+                raise InvalidCursor(f"No update for cursor {cursor!r}")
+            where.append("(date, location, name) < (?, ?, ?)")
+            params.extend((rows[0]["date"], location, name))
+
+        sql = "SELECT * FROM updates"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY date DESC, location DESC, name DESC LIMIT ?"
+        rows = self._execute(sql, (*params, n))
+
+        next_cursor = (
+            f"{rows[-1]['location']}/{rows[-1]['name']}" if len(rows) == n else None
+        )
+        return [_update(row) for row in rows], next_cursor
+
+    def save_latest(self, statuses):
+        self._executemany(
+            "INSERT INTO latest (location, area, date, status, description)"
+            " VALUES (?, ?, ?, ?, ?) ON CONFLICT (location) DO UPDATE SET"
+            " area = excluded.area, date = excluded.date,"
+            " status = excluded.status, description = excluded.description"
+            " WHERE excluded.date > latest.date",
+            (
+                (
+                    name,
+                    area,
+                    status["date"].timestamp(),
+                    status.get("status"),
+                    status.get("description"),
+                )
+                for (area, name), status in statuses.items()
+            ),
+        )
+
+    def find_latest(self, earliest=None, areas=None):
+        where = []
+        params = []
+        if earliest is not None:
+            where.append("date > ?")
+            params.append(earliest.timestamp())
+        if areas is not None:
+            where.append("area IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(areas)))
+
+        sql = "SELECT date, status, description, location FROM latest"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return [_update(row) for row in self._execute(sql, params)]
+
+    def load_last_notified(self, locations):
+        return {
+            name: location["last_notified"]
+            for name, location in self.load_locations(locations).items()
+            if location.get("last_notified") is not None
+        }
+
+    def save_last_notified(self, last_notified):
+        self._executemany(
+            "INSERT INTO locations (location, last_notified) VALUES (?, ?)"
+            " ON CONFLICT (location) DO UPDATE SET last_notified = excluded.last_notified",
+            ((name, date.timestamp()) for name, date in last_notified.items()),
+        )
+
+    def enqueue_messages(self, messages):
+        existing = self._execute(
+            "SELECT id FROM outbox WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(messages)),),
+        )
+        existing = {row["id"] for row in existing}
+        new_ids = [id_ for id_ in messages if id_ not in existing]
+        self._executemany(
+            f"INSERT OR IGNORE INTO outbox (id, {', '.join(_MESSAGE_COLUMNS)})"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((id_, *_message_values(messages[id_])) for id_ in new_ids),
+        )
+        return new_ids
+
+    def find_pending_messages(self, now, n=100):
+        rows = self._execute(
+            "SELECT * FROM outbox WHERE state = 'pending' AND next_attempt <= ?"
+            " ORDER BY next_attempt LIMIT ?",
+            (now.timestamp(), n),
+        )
+        return {row["id"]: _message(row) for row in rows}
+
+    def claim_messages(self, ids, now, until):
+        with self._lock, self._conn:
+            claimed = [
+                id_
+                for id_ in ids
+                if self._conn.execute(
+                    "UPDATE outbox SET next_attempt = ?"
+                    " WHERE id = ? AND state = 'pending' AND next_attempt <= ?",
+                    (until.timestamp(), id_, now.timestamp()),
+                ).rowcount
+            ]
+            rows = self._conn.execute(
+                "SELECT * FROM outbox WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(claimed),),
+            ).fetchall()
+        return {row["id"]: _message(row) for row in rows}
+
+    def update_messages(self, messages):
+        self._executemany(
+            "UPDATE outbox SET state = ?, attempts = ?, next_attempt = ? WHERE id = ?",
+            (
+                (
+                    v["state"],
+                    v["attempts"],
+                    _timestamp(v["next_attempt"]),
+                    id_,
+                )
+                for id_, v in messages.items()
+            ),
+        )
+
+    def load_blob(self, name):
+        rows = self._execute("SELECT data FROM blobs WHERE name = ?", (name,))
+        return rows[0]["data"] if rows else None
+
+    def save_blob(self, name, data):
+        self._execute(
+            "INSERT OR REPLACE INTO blobs (name, data) VALUES (?, ?)", (name, data)
+        )
+
+
+def _location(row):
+    """Location dict from a row."""
+    location = {k: row[k] for k in _LOCATION_COLUMNS}
+    if row["last_notified"] is not None:
+        location["last_notified"] = _datetime(row["last_notified"])
+    return location
+
+
+def _update(row):
+    """Status update dict from a row."""
+    update = {k: row[k] for k in _UPDATE_COLUMNS}
+    update["date"] = _datetime(update["date"])
+    return update
+
+
+def _message(row):
+    """Outbox message dict from a row."""
+    message = {k: row[k] for k in _MESSAGE_COLUMNS}
+    message["date"] = _datetime(message["date"])
+    message["next_attempt"] = _datetime(message["next_attempt"])
+    return message
+
+
+def _message_values(message):
+    """Row values from an outbox message dict."""
+    values = {**message}
+    values["date"] = _timestamp(values["date"])
+    values["next_attempt"] = _timestamp(values["next_attempt"])
+    return tuple(values[k] for k in _MESSAGE_COLUMNS)
+
+
+def _datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def _timestamp(dt):
+    return None if dt is None else dt.timestamp()
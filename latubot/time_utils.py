@@ -14,6 +14,8 @@ def now_tz():
 
 def since_to_delta(since):
     """Convert since to timedelta."""
+    import dateutil.relativedelta
+
     unit_map = {
         "m": "minutes",
         "h": "hours",
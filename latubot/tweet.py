@@ -1,21 +1,23 @@
 """Tweet updates
 
-- Build tweet message from an update
+- Build tweet message from an update, e.g. to queue in the outbox
 - Authenticate correct twitter api based on update location
-- Send tweet
+- Queue tweets per twitter account
+- Send tweets, concurrently to different accounts, spaced per account
 """
 
 import logging
 import functools
+import queue
+import threading
 import time
 import random
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-import tweepy
 import dateutil.tz
 
-from latubot import cfg
-from latubot.update import load_location
+from latubot import cfg, metrics
 
 logger = logging.getLogger(__name__)
 tz_local = dateutil.tz.gettz("Europe/Helsinki")
@@ -26,28 +28,75 @@ TwitterKeys = namedtuple(
 )
 
 
-def tweet_update(update, pretend):
-    """Send tweet for the update."""
-    location = load_location(update["location"])
-    keys = cfg.get_twitter_api_keys(location["type"], location["area"])
-    if keys is None:
-        return None
+def render_tweet(update):
+    """Render tweet message for the update, None w/o a twitter account.
 
-    twitter_api_keys = TwitterKeys(*keys)
-    api = _get_api(twitter_api_keys)
-    if api is None:
-        return
+    Returns {"type", "area", "msg"}, type and area select the account.
+    """
+    location = update.location
+    if cfg.get_twitter_api_keys(location.type, location.area) is None:
+        return None
 
     msg = _build_tweet_msg(location, update)
-    return _send(None if pretend else api, msg)
+    return {"type": location.type, "area": location.area, "msg": msg}
+
 
+def tweet_messages(messages, pretend):
+    """Send rendered tweets, generate (key, ok) tuples as tweets are sent.
+
+    messages: (key, message from render_tweet) tuples
+
+    Tweets are queued per twitter account. Different accounts are tweeted
+    concurrently, tweets to one account are spaced w/ a token bucket. ok is
+    None for messages w/o a twitter account.
+    """
+    queues = defaultdict(list)
+    for k, message in messages:
+        keys = cfg.get_twitter_api_keys(message["type"], message["area"])
+        if keys is None:
+            metrics.inc("tweets_total", area=message["area"], result="no_account")
+            yield k, None
+        else:
+            queues[TwitterKeys(*keys)].append((k, message))
+
+    if not queues:
+        return
 
-def _send(api: tweepy.API, msg: str):
-    """Send tweet w/ authenticated api."""
+    results = queue.Queue()
+
+    def send_all(keys, items):
+        # every item gets a result, also if authentication or spacing fails
+        for k, message in items:
+            msg = message["msg"]
+            ok = False
+            try:
+                api = None if pretend else _get_api(keys)
+                if not pretend:
+                    _get_bucket(keys).acquire()
+                with metrics.timer("tweet", area=message["area"]):
+                    ok = _send(api, msg)
+            except Exception as e:
+                logger.error(f"error {e!r} sending tweet: {msg}")
+            finally:
+                result = "pretend" if pretend else ("ok" if ok else "error")
+                metrics.inc("tweets_total", area=message["area"], result=result)
+                results.put((k, ok))
+
+    with ThreadPoolExecutor(max_workers=len(queues)) as executor:
+        for keys, items in queues.items():
+            executor.submit(send_all, keys, items)
+        for _ in range(sum(len(items) for items in queues.values())):
+            yield results.get()
+
+
+def _send(api, msg: str):
+    """Send tweet w/ authenticated tweepy api, pretend if api is None."""
     if api is None:
         logger.info(f"pretend tweet: {msg}")
         return True
     else:
+        import tweepy
+
         logger.debug(f"send tweet: {msg}")
         try:
             api.update_status(msg)
@@ -55,17 +104,47 @@ def _send(api: tweepy.API, msg: str):
             logger.error(f"error {e} sending tweet: {msg}")
             return False
         else:
-            time.sleep(cfg.SECS_TO_SLEEP_AFTER_TWEET)
             return True
 
 
+class TokenBucket:
+    """Token bucket to space events, rate in tokens per second."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, wait until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+@functools.lru_cache
+def _get_bucket(keys):
+    """Get token bucket spacing tweets for a twitter account."""
+    return TokenBucket(1 / cfg.SECS_TO_SLEEP_AFTER_TWEET, cfg.TWEET_BURST)
+
+
 def _build_tweet_msg(location, update, max_length=280):
     """Build tweet message for the update."""
-    group = location["group"]
-    name = location["name"]
-    date = update["date"].astimezone(tz_local).strftime("%d.%m klo %H:%M")
-    description = update.get("description")
-    is_closed = update.get("status", "").upper() == "CLOSED"
+    group = location.group
+    name = location.name
+    date = update.date.astimezone(tz_local).strftime("%d.%m klo %H:%M")
+    description = update.description
+    is_closed = (update.status or "").upper() == "CLOSED"
     action = "Päivitetty" if is_closed else "Kunnostettu"
 
     msg = f"{group}, {name}; {action} {date}"
@@ -76,7 +155,7 @@ def _build_tweet_msg(location, update, max_length=280):
         if len(msg_) <= max_length:
             msg = msg_
 
-    msg = _add_hashtags(msg, location["area"], max_length)
+    msg = _add_hashtags(msg, location.area, max_length)
     return msg
 
 
@@ -92,7 +171,9 @@ def _add_hashtags(msg: str, area: str, max_length: int = 140):
 
 @functools.lru_cache
 def _get_api(keys):
-    """Get tweepy api for keys."""
+    """Get tweepy api for keys, tweepy is imported only to send tweets."""
+    import tweepy
+
     auth = tweepy.OAuthHandler(keys.consumer_key, keys.consumer_secret)
     auth.set_access_token(keys.access_key, keys.access_secret)
     api = tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
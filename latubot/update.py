@@ -1,19 +1,20 @@
 """Update functions.
 
-- read updates from kunto servers
+- read updates from kunto servers as records.Update
+- skip venues not changed since the previous load of the area
+- keep latest status of each location
 - save updates in firestore db
 
-Example update document:
+Sources are imported on first load, e.g. get_updates only needs storage.
+
+Records are converted to storage dicts when saved, and locations from
+storage to records when loaded, e.g. a status update document:
 
 {
-  'id': 3177061,
-  'name': 'Salonpään yhdyslatu',
-  'type': 'skitrack',
-  'group': 'Oulunsalo',
-  'description': '',
+  'date': datetime.datetime(2019, 3, 25, 11, 28, 49, 171000, tzinfo=<UTC>),
   'status': 'CLOSED',
-  'images': [],
-  'date': datetime.datetime(2019, 3, 25, 13, 28, 49, 171000, tzinfo=tzoffset(None, 7200))
+  'description': '',
+  'location': '1c2a7b3e'
 }
 
 
@@ -21,136 +22,484 @@ Example update document:
 
 import logging
 import hashlib
-from itertools import product, chain
-from typing import Iterable, Mapping
-
-from latubot.source import api
-from latubot.gcloud import get_db
+import os
+import struct
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+from latubot import cfg, metrics, profiling
+from latubot.cache import TTLCache
+from latubot.records import Location, Update
+from latubot.storage.api import get_storage
 
 logger = logging.getLogger(__name__)
 
+# Locations by document name, shared by update, notify and tweet
+_location_cache = TTLCache(cfg.LOCATION_CACHE_SIZE, cfg.LOCATION_CACHE_TTL)
+_all_locations_loaded_at = None
+
+# Keys of already loaded updates w/ the time first seen, see _only_new
+_seen_updates = TTLCache(cfg.SEEN_UPDATES_SIZE, cfg.SEEN_UPDATES_TTL)
+_seen_updates_loaded = False
+_UPDATE_KEY_SIZE = 16
+# Seen updates snapshot: header, then (key, time first seen) records
+_SEEN_UPDATES_HEADER = b"latubot seen updates v2\n"
+_SEEN_UPDATE_RECORD = struct.Struct(f"<{_UPDATE_KEY_SIZE}sd")
+
+# Number of saves w/ new status updates in this process, see save_generation
+_save_generation = 0
+
+# Venue fingerprints by venue key by area from previous loads, see _diff_area
+_area_snapshots = {}
+_VENUE_KEY_SIZE = 8
+
 
-def load_updates(sports=None, areas=None, since=None):
-    """Load updates from kunto into firestore storage."""
+@metrics.summarized
+def load_updates(sports=None, areas=None, since=None, concurrency=None):
+    """Load updates from kunto into storage, return number of new updates."""
+    return len(load_new_updates(sports, areas, since, concurrency))
+
+
+def load_new_updates(
+    sports=None, areas=None, since=None, concurrency=None, changes=None
+):
+    """Load updates from kunto into storage, return new status updates.
+
+    Returned status updates are the saved records, e.g. to notify them
+    w/o reading them back.
+
+    Areas are fetched concurrently, at most `concurrency` at a time
+    (default cfg.MAX_CONCURRENT_FETCHES). Updates are saved in db w/ bulk
+    reads and writes. Areas not modified since the previous load of the
+    same sports and since are skipped, http cache validators are saved
+    only after the updates are saved.
+
+    changes: optional dict to collect number of changed venues by area
+
+    Not timed as a stage itself, load_updates and load_and_notify are.
+    """
+
+    from latubot.source import api
 
     sports = sports or api.sport_names()
     areas = areas or api.area_names()
+    concurrency = concurrency or cfg.MAX_CONCURRENT_FETCHES
     logger.info(f"Load updates for {sports} in {areas} since {since}")
 
-    i = 0
-    n_updated_in_db = 0
-    for i, update in enumerate(_gen_updates(sports, areas, since)):
-        n_updated_in_db += _save_update(update)
+    stats_before = api.http_cache_stats()
+    diffs = {}
+    validators = {}
+    updates, keys = _only_new(
+        _gen_updates(sports, areas, since, concurrency, diffs, validators)
+    )
+    i = len(updates)
+    with metrics.timer("stage", stage="save"):
+        saved = _save_updates(updates)
+    api.save_http_cache(validators)
+    _save_seen_updates(keys)
+    _save_area_snapshots(diffs)
+    if changes is not None:
+        changes.update((area, n) for area, (_, n) in diffs.items())
+
+    stats = {k: v - stats_before[k] for k, v in api.http_cache_stats().items()}
+    n_seen = sum(len(fingerprints) for fingerprints, _ in diffs.values())
+    n_changed = sum(n for _, n in diffs.values())
+    metrics.inc("updates_total", i, state="new")
+    metrics.inc("updates_total", len(saved), state="saved")
+    logger.info(
+        f"Loaded {n_seen} venues, {n_changed} changed, {i} new updates, "
+        f"saved {len(saved)} in db "
+        f"(http cache {stats['hit']} hits, {stats['miss']} misses)"
+    )
+    return saved
+
+
+def _only_new(updates):
+    """Filter out updates seen in previous loads.
+
+    Update keys are cached in a bounded LRU cache once the updates are
+    saved, see _save_seen_updates. Keys are retained between invocations if
+    e.g. google cloud functions are retained, and across restarts if
+    cfg.SEEN_UPDATES_SNAPSHOT is set.
+
+    Returns (new updates, their keys).
+    """
+    _load_seen_updates()
+    logger.debug(f"{len(_seen_updates)} cached updates exist")
+    new = []
+    keys = {}
+    for update in updates:
+        key = _update_key(update)
+        if key not in _seen_updates and key not in keys:
+            new.append(update)
+            keys[key] = True
+    return new, list(keys)
+
+
+def _load_seen_updates():
+    """Load seen update keys from snapshot once per process.
+
+    Snapshots of the previous format (keys only) are ignored.
+    """
+    global _seen_updates_loaded
+    if _seen_updates_loaded or not cfg.SEEN_UPDATES_SNAPSHOT:
+        return
+    _seen_updates_loaded = True
+
+    try:
+        if cfg.SEEN_UPDATES_SNAPSHOT == "db":
+            data = get_storage().load_blob("seen_updates") or b""
+        else:
+            with open(cfg.SEEN_UPDATES_SNAPSHOT, "rb") as f:
+                data = f.read()
+    except OSError as e:
+        logger.info(f"No seen updates loaded ({e})")
+        return
+
+    if data and not data.startswith(_SEEN_UPDATES_HEADER):
+        logger.info("No seen updates loaded (unknown snapshot format)")
+        return
+
+    # keys keep their age, so that they expire like in a single process
+    now = time.time()
+    records = memoryview(data)[len(_SEEN_UPDATES_HEADER) :]
+    n = len(records) // _SEEN_UPDATE_RECORD.size
+    for key, seen in _SEEN_UPDATE_RECORD.iter_unpack(
+        records[: n * _SEEN_UPDATE_RECORD.size]
+    ):
+        ttl = cfg.SEEN_UPDATES_TTL - (now - seen)
+        if ttl > 0:
+            _seen_updates.put(key, seen, ttl)
+    logger.debug(f"Loaded {len(_seen_updates)} seen updates")
+
+
+def _save_seen_updates(keys):
+    """Cache keys of saved updates, and save seen update keys in snapshot."""
+    now = time.time()
+    for key in keys:
+        _seen_updates.put(key, now)
+    if not keys or not cfg.SEEN_UPDATES_SNAPSHOT:
+        return
+
+    data = _SEEN_UPDATES_HEADER + b"".join(
+        _SEEN_UPDATE_RECORD.pack(key, seen) for key, seen in _seen_updates.items()
+    )
+    if cfg.SEEN_UPDATES_SNAPSHOT == "db":
+        get_storage().save_blob("seen_updates", data)
+    else:
+        try:
+            with open(cfg.SEEN_UPDATES_SNAPSHOT, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            logger.error(f"Can't save seen updates ({e})")
 
-    logger.info(f"Loaded {i} updates, saved {n_updated_in_db} in db")
-    return n_updated_in_db
 
+def _gen_updates(sports, areas, since, concurrency=1, diffs=None, validators=None):
+    """Load updates from all sports and areas.
 
-def _only_new(func):
-    """Decorator to yield only new updates.
+    Each area is fetched once for all sports. Fetches run in a thread pool,
+    or in the calling thread if concurrency is 1 or while profiling,
+    updates are yielded in the order of areas. Areas failing to load are
+    logged and skipped, other areas are loaded normally.
 
-    Caches updates in a set, and passes only new updates on subsequent
-    invocations. This affects function invocations during one run,
-    e.g. if google cloud functions are retained between invocations.
+    If diffs (a dict) is given, only venues changed since the area
+    snapshot are yielded, and (venue fingerprints, number of changed
+    venues) are collected by area for _save_area_snapshots.
+
+    validators: optional dict to collect http cache validators, see
+      api.load_area
     """
-    _cache = set()
-
-    def gen(*args, **kwargs):
-        logger.debug(f"{len(_cache)} cached updates exist")
-        for update in func(*args, **kwargs):
-            key = _hash_update(update)
-            if key not in _cache:
-                yield update
-                _cache.add(key)
-
-    return gen
-
-
-@_only_new
-def _gen_updates(sports, areas, since):
-    """Load updates from all sports and areas."""
-    for sport, area in product(sports, areas):
-        logger.debug(f"Load {sport}, {area}")
-        for update in api.load(sport, area, since):
-            update["area"] = area
-            yield update
-
-
-_location_keys = ("area", "type", "group", "name")
-_update_keys = ("date", "status", "description")
-
-
-def _save_update(update):
-    """Save one update in firestore db."""
-    location = {k: v for k, v in update.items() if k in _location_keys}
-    status = {k: v for k, v in update.items() if k in _update_keys}
-    # Save location in status to enable back referencing location from a status
-    status["location"] = _location_doc_name(location)
-
-    location_doc_ref = _save_location(location)
-    updated = _save_status(location_doc_ref, status)
-    if updated:
-        logger.debug(f"{location} updated")
-    return updated
-
-
-def _save_location(location):
-    """Save a location in db, return reference to the document."""
-    doc_name = _location_doc_name(location)
-    doc_ref = get_db().collection("locations").document(doc_name)
-    doc = doc_ref.get()
-    if not doc.exists:
-        doc_ref.set(location)
-    return doc_ref
-
-
-def load_location(doc_name):
-    """Load a location from db by name."""
-    doc_ref = get_db().collection("locations").document(doc_name)
-    doc = doc_ref.get()
-    if not doc.exists:
-        return None
-    else:
-        return doc.to_dict()
 
+    from latubot.source import api
 
-def _save_status(doc_ref, status):
-    """Save a status update in db."""
-    if not status.get("date"):
-        logger.debug(f"No date in {status}, skip")
-        return False
+    def load(area):
+        logger.debug(f"Load {sports}, {area}")
+        try:
+            loaded = api.load_area(area, sports, since, validators=validators)
+        except Exception as e:
+            logger.error(f"Can't load {area} ({e!r})")
+            metrics.inc("load_errors_total", area=area)
+            return area, []
 
-    status_doc_name = _status_doc_name(status)
-    status_ref = doc_ref.collection("updates").document(status_doc_name)
-    status_doc = status_ref.get()
+        updates = chain.from_iterable(loaded.values())
+        if diffs is None:
+            return area, updates
 
-    if status_doc.exists:
-        return False
-    else:
-        status_ref.set(status)
-        return True
+        changed, fingerprints = _diff_area(area, updates)
+        diffs[area] = (fingerprints, len(changed))
+        return area, changed
 
+    if concurrency == 1 or profiling.active():
+        # cProfile records only the calling thread
+        for area in areas:
+            yield from load(area)[1]
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _, updates in executor.map(load, areas):
+            yield from updates
+
+
+def _diff_area(area, updates):
+    """Find venues changed since the area snapshot.
+
+    Returns (changed updates, fingerprints of all venues by venue key).
+    """
+    snapshot = _load_area_snapshot(area)
+    changed = []
+    fingerprints = {}
+    with metrics.timer("stage", stage="diff"):
+        for update in updates:
+            key = _venue_key(update)
+            fingerprint = _venue_fingerprint(update)
+            fingerprints[key] = fingerprint
+            if snapshot.get(key) != fingerprint:
+                changed.append(update)
+
+    metrics.inc("venues_total", len(fingerprints), area=area, state="seen")
+    metrics.inc("venues_total", len(changed), area=area, state="changed")
+
+    logger.debug(f"{area}: {len(changed)} of {len(fingerprints)} venues changed")
+    return changed, fingerprints
+
+
+def _load_area_snapshot(area):
+    """Load venue fingerprints of an area, from storage once per process."""
+    snapshot = _area_snapshots.get(area)
+    if snapshot is not None:
+        return snapshot
+
+    data = b""
+    try:
+        if cfg.AREA_SNAPSHOTS == "db":
+            data = get_storage().load_blob(f"area_snapshot_{area}") or b""
+        elif cfg.AREA_SNAPSHOTS:
+            with open(_area_snapshot_fn(area), "rb") as f:
+                data = f.read()
+    except OSError as e:
+        logger.info(f"No snapshot loaded for {area} ({e})")
+
+    record_size = 2 * _VENUE_KEY_SIZE
+    snapshot = {
+        data[i : i + _VENUE_KEY_SIZE]: data[i + _VENUE_KEY_SIZE : i + record_size]
+        for i in range(0, len(data) - record_size + 1, record_size)
+    }
+    _area_snapshots[area] = snapshot
+    return snapshot
+
+
+def _save_area_snapshots(diffs):
+    """Merge venue fingerprints into area snapshots, save changed snapshots."""
+    for area, (fingerprints, n_changed) in diffs.items():
+        snapshot = _area_snapshots.setdefault(area, {})
+        snapshot.update(fingerprints)
+        if not n_changed or not cfg.AREA_SNAPSHOTS:
+            continue
+
+        data = b"".join(k + v for k, v in snapshot.items())
+        if cfg.AREA_SNAPSHOTS == "db":
+            get_storage().save_blob(f"area_snapshot_{area}", data)
+        else:
+            try:
+                os.makedirs(cfg.AREA_SNAPSHOTS, exist_ok=True)
+                with open(_area_snapshot_fn(area), "wb") as f:
+                    f.write(data)
+            except OSError as e:
+                logger.error(f"Can't save snapshot for {area} ({e})")
+
+
+def _area_snapshot_fn(area):
+    return os.path.join(cfg.AREA_SNAPSHOTS, f"{area}.snapshot")
+
+
+def _save_updates(updates):
+    """Save updates in db w/ bulk reads and writes.
+
+    Returns new status updates saved in db.
+    """
+    locations = {}
+    statuses = {}
+    for update in updates:
+        location_name = update.location.doc_name
+        locations.setdefault(location_name, update.location)
+
+        if not update.date:
+            logger.debug(f"No date in {update}, skip")
+            continue
+        statuses.setdefault((location_name, _status_doc_name(update)), update)
+
+    global _save_generation
+    _save_locations(locations)
+    saved = _save_statuses(statuses)
+    _save_latest(saved)
+    if saved:
+        _save_generation += 1
+    return saved
+
+
+def save_generation():
+    """Number of saves w/ new status updates in this process.
+
+    Changes whenever updates are saved, e.g. to invalidate caches.
+    """
+    return _save_generation
 
-def _location_doc_name(location):
-    """Get unique document name for a location."""
-    values = (location.get(k) for k in _location_keys)
-    return _hash(values)[:8]
 
+def _save_locations(locations):
+    """Save new locations in db, locations by document name."""
+    get_storage().save_locations({k: v.to_dict() for k, v in locations.items()})
+    for name, location in locations.items():
+        _location_cache.put(name, location)
 
-def _status_doc_name(status):
+
+def _save_statuses(updates):
+    """Save new status updates in db, updates by (location, status) names.
+
+    Returns saved updates.
+    """
+    statuses = {k: update.to_status() for k, update in updates.items()}
+    saved = [updates[k] for k in get_storage().save_statuses(statuses)]
+    logger.debug(f"Saved {len(saved)} of {len(statuses)} status updates")
+    return saved
+
+
+def _save_latest(updates):
+    """Save newest of updates per location as latest status in db."""
+    latest = {}
+    for update in updates:
+        key = (update.location.area, update.location.doc_name)
+        if key not in latest or latest[key].date < update.date:
+            latest[key] = update
+    if latest:
+        get_storage().save_latest({k: v.to_status() for k, v in latest.items()})
+
+
+def rebuild_latest():
+    """Rebuild latest statuses of all locations from all status updates.
+
+    Returns the number of locations w/ a latest status.
+    """
+    locations = _locations(get_storage().load_all_locations())
+    statuses = get_storage().find_updates_since(datetime.fromtimestamp(0, timezone.utc))
+    updates = [
+        Update.from_status(s, locations[s["location"]])
+        for s in statuses
+        if s["location"] in locations
+    ]
+    _save_latest(updates)
+    return len({u.location.doc_name for u in updates})
+
+
+def updates_from_statuses(statuses):
+    """Convert status dicts from storage to updates w/ cached locations.
+
+    Statuses of unknown locations are left out.
+    """
+    statuses = list(statuses)
+    locations = load_locations(s["location"] for s in statuses)
+    updates = []
+    for status in statuses:
+        location = locations.get(status["location"])
+        if location is None:
+            logger.warning(f"Skip status of unknown location {status['location']}")
+        else:
+            updates.append(Update.from_status(status, location))
+    return updates
+
+
+def load_locations(doc_names):
+    """Load locations by name w/ one bulk read for uncached locations.
+
+    Returns a dict of locations (records.Location) by name, missing
+    locations are left out.
+    """
+    locations = {}
+    missing = []
+    for doc_name in set(doc_names):
+        location = _location_cache.get(doc_name)
+        if location is None:
+            missing.append(doc_name)
+        else:
+            locations[doc_name] = location
+
+    if missing:
+        loaded = _locations(get_storage().load_locations(missing))
+        for doc_name, location in loaded.items():
+            locations[doc_name] = location
+            _location_cache.put(doc_name, location)
+
+    return locations
+
+
+def warm_location_cache():
+    """Load all locations into cache w/ one query, return number of locations."""
+    global _all_locations_loaded_at
+    locations = _locations(get_storage().load_all_locations())
+    for doc_name, location in locations.items():
+        _location_cache.put(doc_name, location)
+    _all_locations_loaded_at = time.monotonic()
+    logger.debug(f"Cached {len(locations)} locations")
+    return len(locations)
+
+
+def load_all_locations():
+    """Load all locations, returns a dict of locations by name.
+
+    Locations are read from db only if all of them have not been cached
+    within cfg.LOCATION_CACHE_TTL.
+    """
+    loaded_at = _all_locations_loaded_at
+    if loaded_at is None or time.monotonic() - loaded_at > cfg.LOCATION_CACHE_TTL:
+        warm_location_cache()
+
+    locations = {}
+    for doc_name in _location_cache.keys():
+        location = _location_cache.get(doc_name)
+        if location is not None:
+            locations[doc_name] = location
+    return locations
+
+
+def location_cache_stats():
+    """Location cache statistics."""
+    return _location_cache.stats()
+
+
+def _locations(locations):
+    """Convert location dicts from storage to records, by document name."""
+    return {k: Location.from_dict(v, k) for k, v in locations.items()}
+
+
+def _status_doc_name(update: Update):
     """Get unique document name for a status update."""
-    return str(status["date"].timestamp())
+    return str(update.date.timestamp())
+
+
+def _venue_key(update: Update):
+    """Compact fixed size key for a venue in an area."""
+    return _digest((update.location.type, update.id), _VENUE_KEY_SIZE)
+
+
+def _venue_fingerprint(update: Update):
+    """Compact fixed size fingerprint of the venue state in an update."""
+    return _digest(_venue_state(update), _VENUE_KEY_SIZE)
+
+
+def _update_key(update: Update):
+    """Compact fixed size key for an update: area, venue and venue state."""
+    values = (update.location.area, update.location.type, update.id)
+    return _digest(values + _venue_state(update), _UPDATE_KEY_SIZE)
 
 
-def _hash(items: Iterable[str]):
-    """Calculate hash of items."""
-    m = hashlib.sha256()
-    for item in items:
-        m.update(item.encode())
-        m.update(b"\xc0")
-    return m.hexdigest()
+def _venue_state(update: Update):
+    """Values that change when a venue is maintained."""
+    date = update.date
+    return (date and date.timestamp(), update.status, update.description)
 
 
-def _hash_update(update: Mapping):
-    """Hash an update."""
-    return _hash(str(x) for x in chain.from_iterable(sorted(update.items())))
+def _digest(values, size):
+    """Calculate a fixed size binary digest of values."""
+    data = "\x1f".join(map(str, values)).encode()
+    return hashlib.blake2b(data, digest_size=size).digest()
@@ -17,7 +17,15 @@ Notes:
 from latubot.gcloud_functions import (
     load_updates_http,
     notify_http,
+    drain_http,
+    load_and_notify_http,
     get_updates_http,
 )
 
-__all__ = ["load_updates_http", "notify_http", "get_updates_http"]
+__all__ = [
+    "load_updates_http",
+    "notify_http",
+    "drain_http",
+    "load_and_notify_http",
+    "get_updates_http",
+]
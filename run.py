@@ -3,9 +3,19 @@
 import argparse
 import logging
 import json
-
-from latubot.notify import notify, get_updates
-from latubot.update import load_updates
+import sys
+
+from latubot.notify import (
+    notify,
+    load_and_notify,
+    get_updates_page,
+    get_latest_updates,
+)
+from latubot.outbox import drain
+from latubot import daemon, metrics
+from latubot.update import load_updates, rebuild_latest
+from latubot.profiling import Profile
+from latubot.storage.api import init_storage
 from latubot.time_utils import DateTimeEncoder
 
 logger = logging.getLogger(__name__)
@@ -18,25 +28,90 @@ def main(parser):
     logging.basicConfig(level=log_level, format=_LOG_FORMAT)
     logging.Formatter.default_msec_format = "%s.%03d"
 
+    if args.storage:
+        init_storage(args.storage)
+
     if "func" in args:
-        args.func(args)
+        if args.profile:
+            with Profile() as p:
+                args.func(args)
+            p.save(args.profile)
+            print(f"Saved profile in {args.profile}.{{prof,txt}}", file=sys.stderr)
+        else:
+            args.func(args)
+        if args.metrics:
+            _write_metrics(args.metrics)
     else:
         parser.print_help()
 
 
+def _write_metrics(fn):
+    """Write metrics in prometheus text format into file, "-" for stdout."""
+    text = metrics.prometheus_text()
+    if fn == "-":
+        sys.stdout.write(text)
+    else:
+        with open(fn, "w") as f:
+            f.write(text)
+
+
 def _update(args):
     logger.info(f"_update {args}")
-    load_updates(_split(args.sports), _split(args.areas), args.since)
+    load_updates(_split(args.sports), _split(args.areas), args.since, args.concurrency)
 
 
 def _notify(args):
     logger.info(f"_notify {args}")
-    notify(args.since)
+    notify(args.since, drain=not args.no_drain)
+
+
+def _load_and_notify(args):
+    logger.info(f"_load_and_notify {args}")
+    load_and_notify(
+        _split(args.sports),
+        _split(args.areas),
+        args.since,
+        args.notify_since,
+        args.tweet,
+        concurrency=args.concurrency,
+    )
+
+
+def _drain(args):
+    logger.info(f"_drain {args}")
+    drain(args.tweet, args.n)
+
+
+def _rebuild_latest(args):
+    logger.info(f"_rebuild_latest {args}")
+    n = rebuild_latest()
+    print(f"Rebuilt latest status of {n} locations", file=sys.stderr)
+
+
+def _daemon(args):
+    logger.info(f"_daemon {args}")
+    try:
+        daemon.run(
+            _split(args.sports),
+            _split(args.areas) if args.areas else None,
+            args.since,
+            args.notify_since,
+            args.tweet,
+            args.concurrency,
+        )
+    except KeyboardInterrupt:
+        pass
 
 
 def _get_updates(args):
     logger.info(f"_get_updates {args}")
-    print(json.dumps(get_updates(args.filter, args.n), indent=2, cls=DateTimeEncoder, sort_keys=True))
+    if args.latest:
+        updates, next_cursor = get_latest_updates(args.filter, args.n), None
+    else:
+        updates, next_cursor = get_updates_page(args.filter, args.n, args.cursor)
+    print(json.dumps(updates, indent=2, cls=DateTimeEncoder, sort_keys=True))
+    if next_cursor:
+        print(f"next page: --cursor {next_cursor}", file=sys.stderr)
 
 
 def arg_parser():
@@ -52,6 +127,24 @@ def arg_parser():
         help="logging level, default WARNING, each V lowers level"
         " by 10 (WARNING -> INFO -> DEBUG)",
     )
+    parser.add_argument(
+        "--storage",
+        help='storage backend: "firestore", "sqlite:<path>" or "memory",'
+        " default from env var LATUBOT_STORAGE or firestore",
+    )
+
+    parser.add_argument(
+        "--metrics",
+        help='write metrics in prometheus text format into file ("-" for stdout)'
+        " after the command",
+    )
+
+    parser.add_argument(
+        "--profile",
+        metavar="PREFIX",
+        help="profile the command, write raw profile in PREFIX.prof and"
+        " hot spots w/ allocations in PREFIX.txt",
+    )
 
     # Sub parsers
     subparsers = parser.add_subparsers()
@@ -62,17 +155,69 @@ def arg_parser():
     update_parser.add_argument("--sports", "-s", default="latu")
     update_parser.add_argument("--areas", "-a", default="OULU, SYOTE")
     update_parser.add_argument("--since", default="1d")
+    update_parser.add_argument(
+        "--concurrency", "-c", type=int, help="max number of concurrent fetches"
+    )
 
     # notify
     notify_parser = subparsers.add_parser("notify")
     notify_parser.set_defaults(func=_notify)
     notify_parser.add_argument("--since", default="1h")
+    notify_parser.add_argument(
+        "--no-drain", action="store_true", help="only queue notifications"
+    )
+
+    # load_and_notify
+    load_and_notify_parser = subparsers.add_parser("load_and_notify")
+    load_and_notify_parser.set_defaults(func=_load_and_notify)
+    load_and_notify_parser.add_argument("--sports", "-s", default="latu")
+    load_and_notify_parser.add_argument("--areas", "-a", default="OULU, SYOTE")
+    load_and_notify_parser.add_argument("--since", default="1d")
+    load_and_notify_parser.add_argument("--notify-since", default="1h")
+    load_and_notify_parser.add_argument(
+        "--tweet", action="store_true", help="send tweets, pretend by default"
+    )
+    load_and_notify_parser.add_argument(
+        "--concurrency", "-c", type=int, help="max number of concurrent fetches"
+    )
+
+    # drain
+    drain_parser = subparsers.add_parser("drain")
+    drain_parser.set_defaults(func=_drain)
+    drain_parser.add_argument(
+        "--tweet", action="store_true", help="send tweets, pretend by default"
+    )
+    drain_parser.add_argument("-n", type=int, help="max number of notifications")
+
+    # daemon
+    daemon_parser = subparsers.add_parser("daemon")
+    daemon_parser.set_defaults(func=_daemon)
+    daemon_parser.add_argument("--sports", "-s", default="latu")
+    daemon_parser.add_argument("--areas", "-a", help="default all areas")
+    daemon_parser.add_argument("--since", default="1d")
+    daemon_parser.add_argument("--notify-since", default="2h")
+    daemon_parser.add_argument(
+        "--tweet", action="store_true", help="send tweets, pretend by default"
+    )
+    daemon_parser.add_argument(
+        "--concurrency", "-c", type=int, help="max number of concurrent fetches"
+    )
 
     # get_updates
     get_updates_parser = subparsers.add_parser("get_updates")
     get_updates_parser.set_defaults(func=_get_updates)
     get_updates_parser.add_argument("--filter")
     get_updates_parser.add_argument("-n", type=int, default=10)
+    get_updates_parser.add_argument(
+        "--cursor", help="cursor of the next page from previous get_updates"
+    )
+    get_updates_parser.add_argument(
+        "--latest", action="store_true", help="only latest update of each location"
+    )
+
+    # rebuild_latest
+    rebuild_latest_parser = subparsers.add_parser("rebuild_latest")
+    rebuild_latest_parser.set_defaults(func=_rebuild_latest)
 
     return parser
 